@@ -1,18 +1,33 @@
+import argparse
+import glob
 import json
 import os
+import subprocess
+import sys
 import requests
 import urllib.parse
 import time
 import shutil
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from tqdm import tqdm
 from urllib3 import Retry
 from requests.adapters import HTTPAdapter
 
-from utils.network import safe_get, safe_soup, safe_download, DynamicCooldown, RateLimiter
-from utils.file import save_json, chdir_project_root
+from utils.network import (
+    safe_get,
+    safe_get_many,
+    safe_soup,
+    safe_download,
+    DynamicCooldown,
+    RateLimiter,
+    HttpCache,
+)
+from utils.metrics import default_metrics, dump_metrics_from_env
+from utils.file import save_json, chdir_project_root, write_atomic, DownloadManifest
+from utils.frontier import Frontier, DONE, PENDING, default_worker_id
 
 chdir_project_root()
+dump_metrics_from_env()
 
 headers = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
@@ -31,11 +46,24 @@ dynamic_cooldown = DynamicCooldown(
     decrease_factor=0.95,
     jitter=0.3
 )
-rate_limiter = RateLimiter(max_requests_per_second=30)
+# bgm.tv pages, the API and the image host are throttled independently
+rate_limiter = RateLimiter(
+    max_requests_per_second=30,
+    per_host={
+        'bgm.tv': (5, 2),
+        'api.bgm.tv': (30, 10),
+        'lain.bgm.tv': (10, 5),
+    },
+)
+# set HTTP_CACHE=<path> to revalidate unchanged pages instead of refetching
+http_cache = HttpCache.from_env()
 TIMEOUT = 10
+# requests kept in flight by crawl_bangumi_id
+CONCURRENCY = 16
+worker_id = default_worker_id()
 
 ses = requests.Session()
-retry = Retry(total=10, backoff_factor=cooldown, backoff_max=10)
+retry = Retry(total=10, backoff_factor=3, backoff_max=10)
 ses.mount('https', HTTPAdapter(max_retries=retry))
 
 
@@ -47,9 +75,12 @@ def crawl_index(count):
             soup = safe_soup(
                 f'https://bgm.tv/character?orderby=collects&page={i+1}',
                 bar,
+                verbose=False,
                 dynamic_cooldown=dynamic_cooldown,
                 rate_limiter=rate_limiter,
                 headers=headers,
+                cache=http_cache,
+                parse_only=SoupStrainer(id='columnCrtBrowserB'),
             )
             chars = soup.find(id='columnCrtBrowserB').find_all('div')[1]  # type: ignore
             for char in chars.children:
@@ -57,7 +88,6 @@ def crawl_index(count):
                 avatar = 'https:' + char.find('img')['src']
                 name = char.find('h3').find('a').text.strip()
                 # print(id, avatar, name)
-                bar.write(f'{id} {avatar} {name}')
                 ret.append(
                     {
                         'id': str(id),
@@ -65,6 +95,7 @@ def crawl_index(count):
                         'avatar': avatar,
                     }
                 )
+            bar.set_postfix_str(default_metrics.summary(), refresh=False)
     except Exception as e:
         bar.write(str(e))
     return ret
@@ -81,8 +112,10 @@ def crawl_characters(index):
                 f'https://api.bgm.tv/v0/characters/{id}',
                 bar,
                 headers=headers,
+                verbose=False,
                 dynamic_cooldown=dynamic_cooldown,
                 rate_limiter=rate_limiter,
+                cache=http_cache,
             )
             if res is None or res.status_code != 200:
                 bar.write(f'Failed to get character data for {id}')
@@ -93,50 +126,112 @@ def crawl_characters(index):
                 bar.write(f'Failed to parse JSON for {id}: {str(e)}')
                 continue
             ret[id] = data
+            bar.set_postfix_str(default_metrics.summary(), refresh=False)
     except BaseException as e:
         bar.write(str(e))
         return ret, e
     return ret, None
 
 
-def crawl_bangumi_id(index, url, ret: dict = {}):
-    bar = tqdm(index, total=len(index))
+def seed_bangumi_id(frontier: Frontier, count, shard_path, shard_size=1000):
+    # one item per id, payload is the shard file it belongs to; ids already
+    # present in existing shard files are entered as done. Only the first of
+    # several workers started together seeds the queue, the others wait for
+    # it and then find it complete
+    if frontier.stats():
+        return
+    items = []
+    for i in range(1, count // shard_size + 1):
+        ids = range((i - 1) * shard_size + 1, i * shard_size + 1)
+        fname = shard_path.format(i)
+        crawled = {}
+        if os.path.exists(fname):
+            crawled = json.load(open(fname, encoding='utf-8'))
+        items.extend((j, i, DONE if str(j) in crawled else PENDING) for j in ids)
+    frontier.seed(items)
+
+
+def crawl_bangumi_id(frontier: Frontier, url, work_dir, batch=CONCURRENCY * 16):
+    # appends [id, shard, data] lines to this worker's own file in work_dir;
+    # merge_bangumi_id turns them into shard files
+    os.makedirs(work_dir, exist_ok=True)
+    bar = tqdm(total=frontier.remaining())
+    failed = 0
     try:
-        for idx, i in enumerate(bar):
-            bar.set_description('{} {}'.format(i, idx))
-            if str(i) in ret:
-                continue
-            try:
-                res = safe_get(
-                    url.format(i),
+        with open(f'{work_dir}/{worker_id}.jsonl', 'a', encoding='utf-8') as out:
+            for items in frontier.iter_leases(worker_id, batch, poll=10):
+                urls = {url.format(i): (i, shard) for i, shard in items}
+                results = []
+                for u, res in safe_get_many(
+                    urls,
                     bar,
+                    concurrency=CONCURRENCY,
                     headers=headers,
-                    verbose=True,
+                    verbose=False,
                     dynamic_cooldown=dynamic_cooldown,
                     rate_limiter=rate_limiter,
-                )
-                if res is None or res.status_code != 200:
-                    ret[i] = {}
-                    continue
-                try:
-                    ret[i] = res.json()
-                except Exception as e:
-                    bar.write(f'Failed to parse JSON for {i}: {str(e)}')
-                    ret[i] = {}
-            except KeyboardInterrupt as e:
-                raise e
-            except requests.HTTPError as e:
-                if e.response.status_code == 404:
-                    ret[i] = {}
-                else:
-                    raise e
+                    cache=http_cache,
+                ):
+                    i, shard = urls[u]
+                    bar.set_description(i)
+                    bar.set_postfix_str(default_metrics.summary(), refresh=False)
+                    bar.update()
+                    if isinstance(res, requests.HTTPError):
+                        if res.response.status_code == 404:
+                            results.append([i, shard, {}])
+                            continue
+                    if isinstance(res, Exception):
+                        bar.write(f'Failed to get {i}: {str(res)}')
+                        failed += 1
+                        frontier.fail(i, str(res))
+                        continue
+                    try:
+                        results.append([i, shard, res.json()])
+                    except Exception as e:
+                        bar.write(f'Failed to parse JSON for {i}: {str(e)}')
+                        failed += 1
+                        frontier.fail(i, str(e), retry=False)
+                # ids are only marked done once their data is on disk
+                for result in results:
+                    out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+                for i, _, _ in results:
+                    frontier.done(i)
     except BaseException as e:
         bar.write(str(e))
-        return ret, e
-    return ret, None
+        bar.write(f'{failed} failed requests')
+        return e
+    bar.write(f'{failed} failed requests, {frontier.stats()}')
+    return None
+
+
+def merge_bangumi_id(work_dir, shard_path):
+    updates = {}
+    for path in sorted(glob.glob(f'{work_dir}/*.jsonl')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    i, shard, data = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line of a killed worker
+                    continue
+                updates.setdefault(shard, {})[i] = data
+    for shard, items in sorted(updates.items()):
+        fname = shard_path.format(shard)
+        if os.path.exists(fname):
+            crawled = json.load(open(fname, encoding='utf-8'))
+        else:
+            crawled = {}
+        crawled.update(items)
+        write_atomic(
+            fname, json.dumps(crawled, ensure_ascii=False, separators=(',', ':'))
+        )
+    print(f'merged {sum(map(len, updates.values()))} ids into {len(updates)} shards')
 
 
 def download_thumnail(index, chars):
+    manifest = DownloadManifest('bangumi/images/manifest.jsonl')
     bar = tqdm(enumerate(index), total=len(index))
     for idx, i in bar:
         if idx >= len(chars):
@@ -156,15 +251,30 @@ def download_thumnail(index, chars):
             avatar = images['large'].replace(
                 'https://lain.bgm.tv/pic/crt/l/', 'https://lain.bgm.tv/pic/crt/g/'
             )
-            safe_download(avatar, 'bangumi/images/{}-avatar.jpg'.format(id), bar, dynamic_cooldown=dynamic_cooldown, rate_limiter=rate_limiter)
+            safe_download(
+                avatar,
+                'bangumi/images/{}-avatar.jpg'.format(id),
+                bar,
+                verbose=False,
+                dynamic_cooldown=dynamic_cooldown,
+                rate_limiter=rate_limiter,
+                manifest=manifest,
+            )
             # safe_download(images['small'], 'images/{}-small.jpg'.format(id),bar)
             # safe_download(images['grid'], 'images/{}-grid.jpg'.format(id),bar)
             # safe_download(images['medium'], 'images/{}-medium.jpg'.format(id),bar)
             safe_download(
-                images['large'], 'bangumi/images/{}-large.jpg'.format(id), bar, dynamic_cooldown=dynamic_cooldown, rate_limiter=rate_limiter
+                images['large'],
+                'bangumi/images/{}-large.jpg'.format(id),
+                bar,
+                verbose=False,
+                dynamic_cooldown=dynamic_cooldown,
+                rate_limiter=rate_limiter,
+                manifest=manifest,
             )
         except Exception as e:
             bar.write(str(e))
+        bar.set_postfix_str(default_metrics.summary(), refresh=False)
 
 
 # index = crawl_index(9999)
@@ -187,22 +297,6 @@ def download_thumnail(index, chars):
 #     id = i['id']
 #     set20k.add(id)
 
-for i in list(range(1, 175)):
-    print(f'crawl: {(i-1)*1000+1} - {i*1000}')
-    fname = f'bangumi/160k_chars/bgm_chars_160k_{i}.json'
-    if os.path.exists(fname):
-        crawled = json.load(open(fname, encoding='utf-8'))
-    else:
-        crawled = {}
-    subjects, e = crawl_bangumi_id(
-        range((i - 1) * 1000 + 1, i * 1000 + 1),
-        'https://api.bgm.tv/v0/characters/{}',
-        crawled,
-    )
-    save_json(subjects, fname)
-    if type(e) == KeyboardInterrupt:
-        break
-
 # for i in range(1,169):
 #     fname = f'bangumi/160k_subjects/bgm_subjects_160k_{i}.json'
 #     if os.path.exists(fname):
@@ -213,18 +307,65 @@ for i in list(range(1, 175)):
 #         save_json(crawled, fname)
 
 
-for i in list(range(1, 175)):
-    print(f'crawl: {(i-1)*1000+1} - {i*1000}')
-    fname = f'bangumi/160k_subjects/bgm_subjects_160k_{i}.json'
-    if os.path.exists(fname):
-        crawled = json.load(open(fname, encoding='utf-8'))
-    else:
-        crawled = {}
-    subjects, e = crawl_bangumi_id(
-        range((i - 1) * 1000 + 1, i * 1000 + 1),
+# progress lives in <dir>/frontier.db, so an interrupted run picks up where
+# it stopped; `python utils/frontier.py <dir>/frontier.db` shows what is left
+# every crawl talks to api.bgm.tv, so all of them share one set of buckets
+LIMITS_PATH = 'bangumi/limits.db'
+CRAWLS = {
+    'characters': (
+        'https://api.bgm.tv/v0/characters/{}',
+        'bangumi/160k_chars',
+        'bangumi/160k_chars/bgm_chars_160k_{}.json',
+    ),
+    'subjects': (
         'https://api.bgm.tv/v0/characters/{}/subjects',
-        crawled,
+        'bangumi/160k_subjects',
+        'bangumi/160k_subjects/bgm_subjects_160k_{}.json',
+    ),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='crawl bangumi characters by id')
+    parser.add_argument(
+        'mode',
+        nargs='?',
+        default='all',
+        choices=['all', 'worker', 'merge'],
+        help='all: crawl and merge (default); worker: one of several crawling '
+        'processes; merge: write the workers\' output into the shard files',
     )
-    save_json(subjects, fname)
-    if type(e) == KeyboardInterrupt:
-        break
+    parser.add_argument('--crawl', action='append', choices=list(CRAWLS))
+    parser.add_argument(
+        '--processes', type=int, default=1, help='worker processes to start here'
+    )
+    args = parser.parse_args()
+    names = args.crawl or list(CRAWLS)
+
+    if args.mode == 'worker' and args.processes > 1:
+        procs = [
+            subprocess.Popen(
+                [sys.executable, sys.argv[0], 'worker']
+                + [j for name in names for j in ('--crawl', name)]
+            )
+            for _ in range(args.processes)
+        ]
+        for proc in procs:
+            proc.wait()
+    else:
+        if args.mode != 'merge':
+            # politeness limits hold across all workers of every crawl
+            rate_limiter = RateLimiter.from_env(
+                LIMITS_PATH,
+                max_requests_per_second=30,
+                per_host=rate_limiter.per_host,
+            )
+        for name in names:
+            url, dir, shard_path = CRAWLS[name]
+            if args.mode != 'merge':
+                frontier = Frontier(f'{dir}/frontier.db', queue=name)
+                seed_bangumi_id(frontier, 174000, shard_path)
+                e = crawl_bangumi_id(frontier, url, f'{dir}/work')
+                if type(e) == KeyboardInterrupt:
+                    break
+            if args.mode != 'worker':
+                merge_bangumi_id(f'{dir}/work', shard_path)
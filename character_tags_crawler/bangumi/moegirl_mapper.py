@@ -1,10 +1,10 @@
 import re
 from typing import Any
-import opencc
 import os
 from tqdm import tqdm
 
 from utils.file import load_json, save_json, chdir_project_root
+from utils.opencc_conv import jp2s
 
 chdir_project_root()
 
@@ -531,16 +531,8 @@ def is_postfix(a, b):
         return a == b
 
 
-converter = opencc.OpenCC("jp2t.json")
-converter2 = opencc.OpenCC("t2s.json")
-
-
 def conv(t):
-    ret = []
-    for i in t:
-        s = converter2.convert(converter.convert(i))
-        ret.append(s)
-    return ret + t
+    return jp2s.many(t) + t
 
 
 def unique(l):
@@ -880,9 +872,8 @@ for moeid in moegirl_chars:
     if moeid in moegirl_extra:
         char = moegirl_extra[moeid]
         if "本名" in char:
-            for idx, j in enumerate(char["本名"]):
-                j = j.replace(" ", "").lower().strip('"\'')
-                j = converter2.convert(converter.convert(j))
+            real_names = [j.replace(" ", "").lower().strip('"\'') for j in char["本名"]]
+            for idx, j in enumerate(jp2s.many(real_names)):
                 if "不明" in j or "未知" in j or "不详" in j:
                     continue
                 if j not in moe_lookup:
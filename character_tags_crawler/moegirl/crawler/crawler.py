@@ -1,19 +1,41 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import heapq
+import itertools
 import json
+import os
+import subprocess
+import sys
 import traceback
 import requests
 import urllib.parse
 import time
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from urllib3 import Retry
 from requests.adapters import HTTPAdapter
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from threading import Lock
 import threading
 
 from utils.file import *
-from utils.network import safe_soup, quote_all, DynamicCooldown, RateLimiter
+from utils.network import (
+    safe_get,
+    safe_soup,
+    quote_all,
+    canonical_url,
+    SingleFlight,
+    ConcurrencyController,
+    RateLimiter,
+    HttpCache,
+)
+from utils.metrics import default_metrics, dump_metrics_from_env
+from utils.frontier import Frontier, default_worker_id
+from moegirl.crawler.graph import graph_path, tree_to_graph
 
 chdir_project_root()
+dump_metrics_from_env()
 
 # base_url = 'https://zh.moegirl.org.cn'
 
@@ -50,23 +72,38 @@ headers = {
     "accept-encoding": "gzip, deflate",
     "accept-language": "zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7",
 }
-dynamic_cooldown = DynamicCooldown(
-    initial=0.2,
-    min_cooldown=0.1,
-    max_cooldown=5.0,
-    slow_threshold=1.0,
-    fast_threshold=0.3,
-    increase_factor=1.5,
-    decrease_factor=0.95,
-    jitter=0.3
-)
-rate_limiter = RateLimiter(max_requests_per_second=30)
+controller = ConcurrencyController(initial=4, max_window=16)
+rate_limiter = RateLimiter(max_requests_per_second=30, burst=10)
+# set HTTP_CACHE=<path> to revalidate unchanged category pages instead of refetching
+http_cache = HttpCache.from_env()
+# threads fetching category listings, per process
+MAX_WORKERS = 16
+# shared state of `crawler.py worker` processes
+WORK_DIR = 'moegirl/crawler/work'
+# categories reachable from several parents are fetched once while their
+# listing is among the last LISTINGS_MEMO ones; the crawl goes breadth-first,
+# so the parents of a category are usually close together
+LISTINGS_MEMO = 4096
+listings = SingleFlight(memo_size=LISTINGS_MEMO)
+# MOEGIRL_CRAWL_BACKEND=api lists categories through api.php instead of
+# scraping the category pages
+BACKEND = os.getenv('MOEGIRL_CRAWL_BACKEND', 'html')
+API_URL = base_url + '/api.php'
+# `crawl(..., incremental=True)` trusts recent changes this far back, the
+# wiki keeps them for a limited time only
+RECENT_CHANGES_DAYS = 30
+# `crawl` writes the partial tree to its output file this often (seconds)
+# or after this many more pages, whichever comes first
+CHECKPOINT_SECONDS = 300
+CHECKPOINT_PAGES = 20000
+# a refreshed listing with less than this share of the pages or
+# subcategories the tree had is taken for a truncated fetch, not an edit
+REFRESH_MIN_RATIO = 0.5
 
 page_count = 0
 characters = {}
 page_count_lock = Lock()
 characters_lock = Lock()
-dynamic_cooldown_lock = Lock()
 
 
 def unique(l):
@@ -89,6 +126,12 @@ RESET = '\033[0m'
 GREY = '\033[2m'
 
 
+class CountDecreased(RuntimeError):
+    # a listing came back with fewer pages or subcategories than the tree
+    # already has; the crawl stops and keeps what it has
+    pass
+
+
 def uncensor(result):
     name = result['name']
     url = result['url']
@@ -109,12 +152,26 @@ def uncensor(result):
             result['name'] = ret
 
 
-def parse_index(url, ret, stk=[], filter_function=None):
-    global page_count
+def find_article(soup):
+    # the category's main article, from the rendered category description
+    article = soup.find(text='这个分类的对应条目是')
+    if article is None:
+        return None
+    a = article.parent.find('a')
+    if a is None:
+        return None
+    url2 = urllib.parse.unquote(a['href'])
+    if "action=edit" in url2 or url2.startswith('/Category:'):
+        return None
+    ret = {'name': a.string, 'url': url2}
+    uncensor(ret)
+    return ret
 
-    # if len(stk) <= 1:
-    #     del ret['finish1']
-    #     del ret['finish2']
+
+def fetch_listing(url, ret, print_debug):
+    # reads the category page of `url` into ret (article, pages and
+    # subcategories), following the pagination; sets finish1 once complete
+    global page_count
 
     if 'pages' not in ret:
         ret['pages'] = []
@@ -129,11 +186,403 @@ def parse_index(url, ret, stk=[], filter_function=None):
     )
 
     url_now = base_url + '/' + quote_all(url)
-    category_name = url.replace('/Category:', '')
-    depth = len(stk)
+    retry_cnt = None
+    while True:
+        prev_pages_count = len(ret['pages'])
+        prev_subcategories_count = len(ret['subcategories'])
+
+        soup = safe_soup(
+            url_now,
+            headers=headers,
+            verbose=False,
+            cooldown=0,
+            controller=controller,
+            rate_limiter=rate_limiter,
+            cache=http_cache,
+            parse_only=SoupStrainer('div', id='mw-content-text'),
+        )
+        soup = soup.find('div', id='mw-content-text')
+        assert soup is not None
+
+        if 'article' not in ret:
+            article = find_article(soup)
+            if article is not None:
+                ret['article'] = article
+
+        subcategories_div = soup.find(id='mw-subcategories')
+        subcategories_cnt = 0
+        if subcategories_div != None:
+            subcategories_text = subcategories_div.find('p').string
+            assert subcategories_text is not None
+            if '只有' in subcategories_text:
+                subcategories_cnt = 1
+            else:
+                assert '共有' in subcategories_text
+                subcategories_cnt = int(
+                    subcategories_text.split('共有')[-1]
+                    .split('个子分类')[0]
+                    .strip()
+                    .replace(',', '')
+                )
+
+            for a in subcategories_div.find('div', class_='mw-content-ltr').find_all(
+                'a'
+            ):
+                name = a.string
+                if name is None or name.strip() == '':
+                    continue
+                url2 = a['href']
+                if "action=edit" in url2:
+                    continue
+                url_unquote = urllib.parse.unquote(url2)
+                tmp = {
+                    'name': name,
+                    'url': url_unquote,
+                    'pages': [],
+                    'subcategories': [],
+                }
+                uncensor(tmp)
+                subcategories_cur.append(tmp)
+                if tmp['url'] in subcategories_set:
+                    continue
+                subcategories_set.add(tmp['url'])
+                ret['subcategories'].append(tmp)
+            if retry_cnt is not None:
+                diff = len(ret['subcategories']) - prev_subcategories_count
+                if diff > 100:
+                    print_debug(
+                        f'found {diff} new subcategories. reset retry_cnt',
+                        color=YELLOW,
+                    )
+                    retry_cnt = None
+
+        pages_div = soup.find(id='mw-pages')
+        pages_cnt = 0
+        if pages_div != None:
+            pages_cnt_text = pages_div.find('p').string
+            assert pages_cnt_text is not None
+            if '只含有' in pages_cnt_text:
+                pages_cnt = 1
+            else:
+                assert '属于本分类' in pages_cnt_text
+                pages_cnt = int(
+                    pages_cnt_text.split('共')[-1]
+                    .split('个页面')[0]
+                    .strip()
+                    .replace(',', '')
+                )
+
+            for a in pages_div.find('div', class_='mw-content-ltr').find_all('a'):
+                name = a.string
+                if name is None or name.strip() == '':
+                    continue
+                url2 = a['href']
+                if "action=edit" in url2:
+                    continue
+                url_unquote = urllib.parse.unquote(url2)
+                tmp = {'name': name, 'url': url_unquote}
+                uncensor(tmp)
+                pages_cur.append(tmp)
+                if tmp['url'] in pages_set:
+                    continue
+                pages_set.add(tmp['url'])
+                ret['pages'].append(tmp)
+                with page_count_lock:
+                    page_count += 1
+                    if page_count % 1000 == 0:
+                        print_debug(
+                            f'Progress: {page_count} pages crawled, '
+                            + default_metrics.summary(),
+                            color=GREEN,
+                        )
+
+            if retry_cnt is not None:
+                diff = len(ret['pages']) - prev_pages_count
+                if diff > 100:
+                    print_debug(
+                        f'found {diff} new pages. reset retry_cnt',
+                        color=YELLOW,
+                    )
+                    retry_cnt = None
+
+        next = soup.find_all('a', text='下一页')
+        if len(next) != 0 and retry_cnt is None:
+            if len(next) != 2:
+                print_debug('UNEXPECTED NEXT COUNT!!!', color=ERROR)
+                print_debug(next, color=ERROR)
+                raise RuntimeError('Unexpected next count')
+            next_url = next[0]['href']
+
+            if 'pagefrom=' in next_url:
+                next_index = len(pages_cur) - 3
+                while next_index >= 0 and ':' in pages_cur[next_index]['name']:
+                    next_index -= 1
+                if next_index < len(pages_cur) - 180:
+                    next_index = len(pages_cur) - 3
+                url_now = (
+                    base_url
+                    + '/'
+                    + quote_all(url)
+                    + '?pagefrom='
+                    + quote_all(pages_cur[next_index]['name'])
+                )
+            elif 'subcatfrom=' in next_url:
+                next_index = len(subcategories_cur) - 3
+                while next_index >= 0 and ':' in subcategories_cur[next_index]['name']:
+                    next_index -= 1
+                if next_index < len(subcategories_cur) - 180:
+                    next_index = len(subcategories_cur) - 3
+                url_now = (
+                    base_url
+                    + '/'
+                    + quote_all(url)
+                    + '?subcatfrom='
+                    + quote_all(subcategories_cur[next_index]['name'])
+                )
+            # url_now = base_url + next_url.replace(
+            #     'index.php?title=', ''
+            # ).replace('&', '?')
+        else:
+            if len(ret['subcategories']) > 0 and subcategories_cnt == 0:
+                print_debug('has subcategories before but now none?!!!', color=ERROR)
+                ret['subcategories'] = []
+                raise CountDecreased('subcategories count decreased')
+            if len(ret['pages']) > 0 and pages_cnt == 0:
+                print_debug('has pages before but now none?!!!', color=ERROR)
+                ret['pages'] = []
+                raise CountDecreased('pages count decreased')
+
+            subcategories_cnt_error = False
+            pages_cnt_error = False
+            if len(ret['subcategories']) < subcategories_cnt:
+                print_debug(
+                    'subcategories_cnt too small!!!',
+                    color=ERROR,
+                )
+                print_debug(
+                    'expected: {}, got: {}'.format(
+                        subcategories_cnt, len(ret['subcategories'])
+                    ),
+                    color=ERROR,
+                )
+                subcategories_cnt_error = True
+                if retry_cnt is None:
+                    retry_cnt = len(ret['subcategories']) - 2
+            elif len(ret['subcategories']) > subcategories_cnt:
+                print_debug(
+                    'subcategories_cnt too large??!',
+                    color=YELLOW,
+                )
+                print_debug(
+                    'expected: {}, got: {}'.format(
+                        subcategories_cnt, len(ret['subcategories'])
+                    ),
+                    color=YELLOW,
+                )
+            if len(ret['pages']) < pages_cnt:
+                print_debug(
+                    'pages_cnt too small!!!',
+                    color=ERROR,
+                )
+                print_debug(
+                    'expected: {}, got: {}'.format(pages_cnt, len(ret['pages'])),
+                    color=ERROR,
+                )
+                pages_cnt_error = True
+                if retry_cnt is None:
+                    retry_cnt = len(ret['pages']) - 2
+            elif len(ret['pages']) > pages_cnt:
+                print_debug('pages_cnt too large??!', color=YELLOW)
+                print_debug(
+                    'expected: {}, got: {}'.format(pages_cnt, len(ret['pages'])),
+                    color=YELLOW,
+                )
+
+            assert not (pages_cnt_error and subcategories_cnt_error)
+            if pages_cnt_error or subcategories_cnt_error:
+                assert retry_cnt is not None
+                print_debug(f"retry_cnt: {retry_cnt}", color=ERROR)
+                if retry_cnt < 0:
+                    print_debug(
+                        'reached max retry for next page. give up',
+                        color=ERROR,
+                    )
+                    break
+                if pages_cnt_error:
+                    url_now = (
+                        base_url
+                        + '/'
+                        + quote_all(url)
+                        + '?pagefrom='
+                        + quote_all(ret['pages'][retry_cnt]['name'])
+                    )
+                    retry_cnt -= 42
+                    continue
+                if subcategories_cnt_error:
+                    url_now = (
+                        base_url
+                        + '/'
+                        + quote_all(url)
+                        + '?subcatfrom='
+                        + quote_all(ret['subcategories'][retry_cnt]['name'])
+                    )
+                    retry_cnt -= 42
+                    continue
+            ret['finish1'] = True
+            # print_debug('finish1', color=GREY)
+            break
+
+
+def fetch_api(params, missing_ok=False):
+    res = safe_get(
+        API_URL + '?' + urllib.parse.urlencode(params),
+        headers=headers,
+        verbose=False,
+        cooldown=0,
+        controller=controller,
+        rate_limiter=rate_limiter,
+        cache=http_cache,
+    ).json()
+    if 'error' in res:
+        if missing_ok and res['error'].get('code') == 'missingtitle':
+            return res
+        raise RuntimeError('api error: {}'.format(res['error'].get('info')))
+    return res
 
-    stk2 = stk.copy()
-    stk2.append(url)
+
+def fetch_article_api(url):
+    # the main article is only in the rendered description of the category
+    # page, which action=parse returns without the member lists
+    res = fetch_api(
+        {
+            'action': 'parse',
+            'page': url.lstrip('/'),
+            'prop': 'text',
+            'format': 'json',
+            'formatversion': '2',
+        },
+        missing_ok=True,
+    )
+    if 'error' in res:
+        # a category without a description page
+        return None
+    return find_article(BeautifulSoup(res['parse']['text'], 'html.parser'))
+
+
+def fetch_listing_api(url, ret, print_debug):
+    # same result as fetch_listing from list=categorymembers, which pages
+    # through complete member lists with continuation tokens, and
+    # action=parse for the main article
+    global page_count
+
+    if 'pages' not in ret:
+        ret['pages'] = []
+    if 'subcategories' not in ret:
+        ret['subcategories'] = []
+
+    pages_set = set(map(lambda x: x['url'], ret['pages']))
+    subcategories_set = set(map(lambda x: x['url'], ret['subcategories']))
+
+    params = {
+        'action': 'query',
+        'list': 'categorymembers',
+        'cmtitle': url.lstrip('/'),
+        'cmtype': 'page|subcat',
+        'cmprop': 'title|type',
+        'cmlimit': 'max',
+        'format': 'json',
+        'formatversion': '2',
+    }
+    if 'article' not in ret:
+        article = fetch_article_api(url)
+        if article is not None:
+            ret['article'] = article
+    while True:
+        res = fetch_api(params)
+        for i in res['query']['categorymembers']:
+            if i['type'] == 'subcat':
+                name = i['title'].split(':', 1)[1]
+                tmp = {
+                    'name': name,
+                    'url': '/Category:' + name.replace(' ', '_'),
+                    'pages': [],
+                    'subcategories': [],
+                }
+                uncensor(tmp)
+                if tmp['url'] in subcategories_set:
+                    continue
+                subcategories_set.add(tmp['url'])
+                ret['subcategories'].append(tmp)
+            else:
+                tmp = {'name': i['title'], 'url': '/' + i['title'].replace(' ', '_')}
+                uncensor(tmp)
+                if tmp['url'] in pages_set:
+                    continue
+                pages_set.add(tmp['url'])
+                ret['pages'].append(tmp)
+                with page_count_lock:
+                    page_count += 1
+                    if page_count % 1000 == 0:
+                        print_debug(
+                            f'Progress: {page_count} pages crawled, '
+                            + default_metrics.summary(),
+                            color=GREEN,
+                        )
+        if 'continue' not in res:
+            break
+        params.update(res['continue'])
+    ret['finish1'] = True
+
+
+def new_listing(url, print_debug):
+    listing = {}
+    if BACKEND == 'api':
+        fetch_listing_api(url, listing, print_debug)
+    else:
+        fetch_listing(url, listing, print_debug)
+    return listing
+
+
+def fetch_listing_once(url, print_debug):
+    return listings.do(canonical_url(url), lambda: new_listing(url, print_debug))
+
+
+def apply_listing(ret, listing, replace=False):
+    # copies a shared listing into a tree node, keeping what the node had;
+    # with replace, a complete listing replaces the pages and subcategories
+    # and only the subtrees of subcategories still listed are kept
+    if replace and 'finish1' in listing:
+        for field in ('subcategories', 'pages'):
+            before = len(ret.get(field, []))
+            after = len(listing[field])
+            if before > 0 and after < before * REFRESH_MIN_RATIO:
+                raise CountDecreased(f'{field} count decreased ({before} -> {after})')
+        if 'article' in listing:
+            ret['article'] = listing['article']
+        children = {i['url']: i for i in ret['subcategories']}
+        ret['pages'] = list(listing['pages'])
+        ret['subcategories'] = [
+            children.get(i['url']) or dict(i, pages=[], subcategories=[])
+            for i in listing['subcategories']
+        ]
+        ret['finish1'] = True
+        return
+    if 'article' in listing and 'article' not in ret:
+        ret['article'] = listing['article']
+    pages_set = set(map(lambda x: x['url'], ret['pages']))
+    ret['pages'].extend(i for i in listing['pages'] if i['url'] not in pages_set)
+    subcategories_set = set(map(lambda x: x['url'], ret['subcategories']))
+    ret['subcategories'].extend(
+        dict(i, pages=[], subcategories=[])
+        for i in listing['subcategories']
+        if i['url'] not in subcategories_set
+    )
+    if 'finish1' in listing:
+        ret['finish1'] = True
+
+
+def debug_printer(url, depth):
+    category_name = url.replace('/Category:', '')
 
     def print_debug(s, color=None):
         if color:
@@ -141,280 +590,85 @@ def parse_index(url, ret, stk=[], filter_function=None):
         else:
             print('  ' * depth + category_name + ':', s)
 
-    if filter_function and not filter_function(stk2):
-        ret['finish1'] = True
-        ret['finish2'] = True
-        print_debug('filtered.', color=CYAN)
-        return
+    return print_debug
 
-    try:
-        print_debug('', color=YELLOW)
-        if 'finish1' in ret:
-            print_debug('already finish1. skip', color=GREY)
-        else:
-            retry_cnt = None
-            while True:
-                prev_pages_count = len(ret['pages'])
-                prev_subcategories_count = len(ret['subcategories'])
-
-                print('  ' * depth, end='')
-
-                soup = safe_soup(
-                    url_now,
-                    headers=headers,
-                    dynamic_cooldown=dynamic_cooldown,
-                    rate_limiter=rate_limiter,
-                )
-                soup = soup.find('div', id='mw-content-text')
-                assert soup is not None
-
-                if 'article' not in ret:
-                    article = soup.find(text='这个分类的对应条目是')
-                    if article != None:
-                        a = article.parent.find('a')
-                        url2 = urllib.parse.unquote(a['href'])
-                        if "action=edit" not in url2 and not url2.startswith(
-                            '/Category:'
-                        ):
-                            ret['article'] = {
-                                'name': a.string,
-                                'url': url2,
-                            }
-                            uncensor(ret['article'])
-
-                subcategories_div = soup.find(id='mw-subcategories')
-                subcategories_cnt = 0
-                if subcategories_div != None:
-                    subcategories_text = subcategories_div.find('p').string
-                    assert subcategories_text is not None
-                    if '只有' in subcategories_text:
-                        subcategories_cnt = 1
-                    else:
-                        assert '共有' in subcategories_text
-                        subcategories_cnt = int(
-                            subcategories_text.split('共有')[-1]
-                            .split('个子分类')[0]
-                            .strip()
-                            .replace(',', '')
-                        )
 
-                    for a in subcategories_div.find(
-                        'div', class_='mw-content-ltr'
-                    ).find_all('a'):
-                        name = a.string
-                        if name is None or name.strip() == '':
-                            continue
-                        url2 = a['href']
-                        if "action=edit" in url2:
-                            continue
-                        url_unquote = urllib.parse.unquote(url2)
-                        tmp = {
-                            'name': name,
-                            'url': url_unquote,
-                            'pages': [],
-                            'subcategories': [],
-                        }
-                        uncensor(tmp)
-                        subcategories_cur.append(tmp)
-                        if tmp['url'] in subcategories_set:
-                            continue
-                        subcategories_set.add(tmp['url'])
-                        ret['subcategories'].append(tmp)
-                    if retry_cnt is not None:
-                        diff = len(ret['subcategories']) - prev_subcategories_count
-                        if diff > 100:
-                            print_debug(
-                                f'found {diff} new subcategories. reset retry_cnt',
-                                color=YELLOW,
-                            )
-                            retry_cnt = None
-
-                pages_div = soup.find(id='mw-pages')
-                pages_cnt = 0
-                if pages_div != None:
-                    pages_cnt_text = pages_div.find('p').string
-                    assert pages_cnt_text is not None
-                    if '只含有' in pages_cnt_text:
-                        pages_cnt = 1
-                    else:
-                        assert '属于本分类' in pages_cnt_text
-                        pages_cnt = int(
-                            pages_cnt_text.split('共')[-1]
-                            .split('个页面')[0]
-                            .strip()
-                            .replace(',', '')
-                        )
+def parse_index(
+    url,
+    ret,
+    stk=[],
+    filter_function=None,
+    max_workers=MAX_WORKERS,
+    refresh=None,
+    lock=None,
+):
+    # Crawls the tree below url breadth-first with one pool of max_workers
+    # threads. The threads only fetch listings; the tree, the queue and the
+    # pending-children counters behind finish2 belong to this thread, so no
+    # thread ever waits on its children. Categories in `refresh` (canonical
+    # urls) get their listing replaced instead of merged. `lock`, if given,
+    # is held while the tree is changed, for readers in other threads.
+    # CountDecreased stops the whole crawl.
+    refresh = refresh or set()
+    lock = lock or contextlib.nullcontext()
+    queue = []
+    counter = itertools.count()
 
-                    for a in pages_div.find('div', class_='mw-content-ltr').find_all(
-                        'a'
-                    ):
-                        name = a.string
-                        if name is None or name.strip() == '':
-                            continue
-                        url2 = a['href']
-                        if "action=edit" in url2:
-                            continue
-                        url_unquote = urllib.parse.unquote(url2)
-                        tmp = {'name': name, 'url': url_unquote}
-                        uncensor(tmp)
-                        pages_cur.append(tmp)
-                        if tmp['url'] in pages_set:
-                            continue
-                        pages_set.add(tmp['url'])
-                        ret['pages'].append(tmp)
-                        with page_count_lock:
-                            page_count += 1
-                            if page_count % 1000 == 0:
-                                print_debug(f'Progress: {page_count} pages crawled', color=GREEN)
-
-                    if retry_cnt is not None:
-                        diff = len(ret['pages']) - prev_pages_count
-                        if diff > 100:
-                            print_debug(
-                                f'found {diff} new pages. reset retry_cnt',
-                                color=YELLOW,
-                            )
-                            retry_cnt = None
-
-                next = soup.find_all('a', text='下一页')
-                if len(next) != 0 and retry_cnt is None:
-                    if len(next) != 2:
-                        print_debug('UNEXPECTED NEXT COUNT!!!', color=ERROR)
-                        print_debug(next, color=ERROR)
-                        raise RuntimeError('Unexpected next count')
-                    next_url = next[0]['href']
-
-                    if 'pagefrom=' in next_url:
-                        next_index = len(pages_cur) - 3
-                        while next_index >= 0 and ':' in pages_cur[next_index]['name']:
-                            next_index -= 1
-                        if next_index < len(pages_cur) - 180:
-                            next_index = len(pages_cur) - 3
-                        url_now = (
-                            base_url
-                            + '/'
-                            + quote_all(url)
-                            + '?pagefrom='
-                            + quote_all(pages_cur[next_index]['name'])
-                        )
-                    elif 'subcatfrom=' in next_url:
-                        next_index = len(subcategories_cur) - 3
-                        while (
-                            next_index >= 0
-                            and ':' in subcategories_cur[next_index]['name']
-                        ):
-                            next_index -= 1
-                        if next_index < len(subcategories_cur) - 180:
-                            next_index = len(subcategories_cur) - 3
-                        url_now = (
-                            base_url
-                            + '/'
-                            + quote_all(url)
-                            + '?subcatfrom='
-                            + quote_all(subcategories_cur[next_index]['name'])
-                        )
-                    # url_now = base_url + next_url.replace(
-                    #     'index.php?title=', ''
-                    # ).replace('&', '?')
+    def finish(task):
+        # the subtree below task is done, which may complete its parents
+        while task is not None:
+            node = task['ret']
+            if 'finish1' in node and 'finish2' not in node:
+                stk2 = task['stk'] + [task['url']]
+                if all(
+                    'finish2' in i or i['url'] in stk2 for i in node['subcategories']
+                ):
+                    node['finish2'] = True
                 else:
-                    if len(ret['subcategories']) > 0 and subcategories_cnt == 0:
-                        print_debug(
-                            'has subcategories before but now none?!!!', color=ERROR
-                        )
-                        ret['subcategories'] = []
-                        raise RuntimeError('subcategories count decreased')
-                    if len(ret['pages']) > 0 and pages_cnt == 0:
-                        print_debug('has pages before but now none?!!!', color=ERROR)
-                        ret['pages'] = []
-                        raise RuntimeError('pages count decreased')
-
-                    subcategories_cnt_error = False
-                    pages_cnt_error = False
-                    if len(ret['subcategories']) < subcategories_cnt:
-                        print_debug(
-                            'subcategories_cnt too small!!!',
-                            color=ERROR,
-                        )
-                        print_debug(
-                            'expected: {}, got: {}'.format(
-                                subcategories_cnt, len(ret['subcategories'])
-                            ),
-                            color=ERROR,
-                        )
-                        subcategories_cnt_error = True
-                        if retry_cnt is None:
-                            retry_cnt = len(ret['subcategories']) - 2
-                    elif len(ret['subcategories']) > subcategories_cnt:
-                        print_debug(
-                            'subcategories_cnt too large??!',
-                            color=YELLOW,
-                        )
-                        print_debug(
-                            'expected: {}, got: {}'.format(
-                                subcategories_cnt, len(ret['subcategories'])
-                            ),
-                            color=YELLOW,
-                        )
-                    if len(ret['pages']) < pages_cnt:
-                        print_debug(
-                            'pages_cnt too small!!!',
-                            color=ERROR,
-                        )
-                        print_debug(
-                            'expected: {}, got: {}'.format(
-                                pages_cnt, len(ret['pages'])
-                            ),
-                            color=ERROR,
-                        )
-                        pages_cnt_error = True
-                        if retry_cnt is None:
-                            retry_cnt = len(ret['pages']) - 2
-                    elif len(ret['pages']) > pages_cnt:
-                        print_debug('pages_cnt too large??!', color=YELLOW)
-                        print_debug(
-                            'expected: {}, got: {}'.format(
-                                pages_cnt, len(ret['pages'])
-                            ),
-                            color=YELLOW,
-                        )
+                    task['print_debug'](
+                        'what happened? why not finish2? anyway', color=ERROR
+                    )
+            task = task['parent']
+            if task is None:
+                return
+            task['pending'] -= 1
+            if task['pending'] > 0:
+                return
 
-                    assert not (pages_cnt_error and subcategories_cnt_error)
-                    if pages_cnt_error or subcategories_cnt_error:
-                        assert retry_cnt is not None
-                        print_debug(f"retry_cnt: {retry_cnt}", color=ERROR)
-                        if retry_cnt < 0:
-                            print_debug(
-                                'reached max retry for next page. give up',
-                                color=ERROR,
-                            )
-                            break
-                        if pages_cnt_error:
-                            url_now = (
-                                base_url
-                                + '/'
-                                + quote_all(url)
-                                + '?pagefrom='
-                                + quote_all(ret['pages'][retry_cnt]['name'])
-                            )
-                            retry_cnt -= 42
-                            continue
-                        if subcategories_cnt_error:
-                            url_now = (
-                                base_url
-                                + '/'
-                                + quote_all(url)
-                                + '?subcatfrom='
-                                + quote_all(ret['subcategories'][retry_cnt]['name'])
-                            )
-                            retry_cnt -= 42
-                            continue
-                    ret['finish1'] = True
-                    # print_debug('finish1', color=GREY)
-                    break
+    def start(url, ret, stk, parent):
+        if 'pages' not in ret:
+            ret['pages'] = []
+        if 'subcategories' not in ret:
+            ret['subcategories'] = []
+        task = {
+            'url': url,
+            'ret': ret,
+            'stk': stk,
+            'parent': parent,
+            'pending': 0,
+            'print_debug': debug_printer(url, len(stk)),
+        }
+        print_debug = task['print_debug']
+        if filter_function and not filter_function(stk + [url]):
+            ret['finish1'] = True
+            ret['finish2'] = True
+            print_debug('filtered.', color=CYAN)
+            finish(task)
+            return
+        print_debug('', color=YELLOW)
+        if 'finish1' in ret:
+            print_debug('already finish1. skip', color=GREY)
+            expand(task)
+        else:
+            heapq.heappush(queue, (len(stk), next(counter), task))
 
+    def expand(task):
+        ret = task['ret']
+        print_debug = task['print_debug']
         # assert 'finish1' in ret
         if 'finish1' not in ret:
             print_debug('what happened? why not finish1? skip', color=ERROR)
+            finish(task)
             return
 
         print_debug(
@@ -426,108 +680,115 @@ def parse_index(url, ret, stk=[], filter_function=None):
 
         if 'finish2' in ret:
             print_debug('already finish2. return', color=GREY)
-        else:
-            ret['subcategories'] = unique(ret['subcategories'])
-            
-            with ThreadPoolExecutor(max_workers=8) as executor:
-                futures = {}
-                for i in ret['subcategories']:
-                    name = i['name']
-                    future = executor.submit(
-                        parse_index,
-                        i['url'],
-                        i,
-                        stk2,
-                        filter_function=filter_function,
-                    )
-                    futures[future] = name
-                
-                for future in as_completed(futures):
-                    name = futures[future]
+            finish(task)
+            return
+        ret['subcategories'] = unique(ret['subcategories'])
+        stk2 = task['stk'] + [task['url']]
+        # a category that contains one of its ancestors is not walked again
+        children = [i for i in ret['subcategories'] if i['url'] not in stk2]
+        if not children:
+            finish(task)
+            return
+        task['pending'] = len(children)
+        for i in children:
+            start(i['url'], i, stk2, task)
+
+    with lock:
+        start(url, ret, stk, None)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    running = {}
+    try:
+        while queue or running:
+            while queue and len(running) < max_workers:
+                _, _, task = heapq.heappop(queue)
+                future = executor.submit(
+                    fetch_listing_once, task['url'], task['print_debug']
+                )
+                running[future] = task
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            with lock:
+                for future in done:
+                    task = running.pop(future)
                     try:
-                        future.result()
+                        apply_listing(
+                            task['ret'],
+                            future.result(),
+                            canonical_url(task['url']) in refresh,
+                        )
+                    except CountDecreased:
+                        raise
+                    except requests.HTTPError as e:
+                        if e.response.status_code == 404:
+                            task['print_debug']('fine. 404 then.', color=ERROR)
+                        else:
+                            task['print_debug'](traceback.format_exc(), color=ERROR)
                     except Exception as e:
-                        print_debug(f'Error processing {name}: {str(e)}', color=ERROR)
+                        task['print_debug'](
+                            f'Error processing {task["url"]}: {str(e)}', color=ERROR
+                        )
                         traceback.print_exc()
+                    expand(task)
+    finally:
+        # on Ctrl-C the fetches still running only touch their own listing
+        executor.shutdown(wait=False, cancel_futures=True)
 
-            flag = True
-            for i in ret['subcategories']:
-                if 'finish2' not in i:
-                    flag = False
-            if flag:
-                ret['finish2'] = True
-            else:
-                print_debug('what happened? why not finish2? anyway', color=ERROR)
 
-    except requests.HTTPError as e:
-        if e.response.status_code == 404:
-            print_debug('fine. 404 then.', color=ERROR)
-            # ret['finish1'] = True
-            # ret['finish2'] = True
-        else:
-            print_debug(RESET)
-            print_debug(traceback.format_exc(), color=ERROR)
-    # except requests.ConnectionError as e:
-    #     print_debug(RESET)
-    #     print_debug(traceback.format_exc(), color=ERROR)
-
-
-def merge(s, t, depth=0):
-    if 'name' in s:
-        assert 'url' in s
-    if 'name' in t:
-        assert 'url' in t
-    if 'name' in t:
-        if 'name' in s:
-            assert s['name'] == t['name']
-            assert s['url'] == t['url']
-        else:
-            s['name'] = t['name']
-            s['url'] = t['url']
-            print('  ' * depth + 'merge name: ', s['name'])
-            print('  ' * depth + 'merge url: ', s['url'])
-    # if 'name' in s:
-    #     print('  '*depth+'merging:', s['name'])
-    if 'article' in t:
-        if 'article' in s:
-            assert t['article']['name'] == s['article']['name']
-            assert t['article']['url'] == s['article']['url']
-        else:
-            s['article'] = t['article']
-            print('  ' * depth + 'merge article: ', s['article'])
-    if 'pages' in t:
-        if 'pages' not in s:
-            s['pages'] = []
-        tmp = []
-        for i in t['pages']:
-            flag = False
-            for j in s['pages']:
-                if j['name'] == i['name']:
-                    assert j['url'] == i['url']
-                    flag = True
-                    break
-            if not flag:
-                tmp.append(i)
-        if len(tmp) > 0 and 'name' in s:
-            print('  ' * depth + 'extra pages for ' + s['name'], len(tmp))
-        s['pages'].extend(tmp)
-    if 'subcategories' in t:
-        if 'subcategories' not in s:
-            s['subcategories'] = []
-        tmp = []
-        for i in t['subcategories']:
-            flag = False
-            for jdx, j in enumerate(s['subcategories']):
-                if i['name'] == j['name']:
-                    assert i['url'] == j['url']
-                    s['subcategories'][jdx] = merge(j, i, depth + 1)
-                    flag = True
-                    break
-            if not flag:
-                tmp.append(i)
-        if len(tmp) > 0 and 'name' in s:
-            print('  ' * depth + 'extra subcategories for ' + s['name'], len(tmp))
-        s['subcategories'].extend(tmp)
+def merge(s, t, conflicts=None):
+    # Merges the tree t into s in place and returns s. Children are matched
+    # by name through a dict per node and the trees are walked with an
+    # explicit stack, so the cost is linear in the size of t and the depth
+    # is unbounded. Where the trees disagree (same name, different url or
+    # article) s wins and (path, field, s value, t value) is reported and
+    # appended to `conflicts`.
+    if conflicts is None:
+        conflicts = []
+
+    def conflict(path, field, a, b):
+        print('conflict at {} ({}): {} != {}'.format(' > '.join(path), field, a, b))
+        conflicts.append((path, field, a, b))
+
+    stack = [(s, t, [])]
+    while stack:
+        node, other, path = stack.pop()
+        indent = '  ' * len(path)
+        if 'name' in other:
+            if 'name' in node:
+                for field in ('name', 'url'):
+                    if node.get(field) != other.get(field):
+                        conflict(path, field, node.get(field), other.get(field))
+            else:
+                node['name'] = other['name']
+                node['url'] = other['url']
+                print(indent + 'merge name: ', node['name'])
+                print(indent + 'merge url: ', node['url'])
+        if 'article' in other:
+            if 'article' in node:
+                if (node['article']['name'], node['article']['url']) != (
+                    other['article']['name'],
+                    other['article']['url'],
+                ):
+                    conflict(path, 'article', node['article'], other['article'])
+            else:
+                node['article'] = other['article']
+                print(indent + 'merge article: ', node['article'])
+        for field in ('pages', 'subcategories'):
+            if field not in other:
+                continue
+            children = node.setdefault(field, [])
+            index = {i['name']: i for i in children}
+            extra = 0
+            for i in other[field]:
+                j = index.get(i['name'])
+                if j is None:
+                    index[i['name']] = i
+                    children.append(i)
+                    extra += 1
+                elif j['url'] != i['url']:
+                    conflict(path + [i['name']], 'url', j['url'], i['url'])
+                elif field == 'subcategories':
+                    stack.append((j, i, path + [i['name']]))
+            if extra > 0 and 'name' in node:
+                print(indent + 'extra {} for {}'.format(field, node['name']), extra)
     return s
 
 
@@ -545,28 +806,229 @@ def parse_index2(url, **args):
     return ret
 
 
-def crawl(root: str, path: str, filter_function=None):
+def recent_category_changes(since: str) -> set:
+    # canonical urls of the categories whose members changed (categorize
+    # entries) or which were edited, created, moved or deleted since `since`
+    params = {
+        'action': 'query',
+        'list': 'recentchanges',
+        'rcend': since,
+        'rcnamespace': '14',
+        'rctype': 'categorize|edit|new|log',
+        'rcprop': 'title|timestamp|loginfo',
+        'rclimit': 'max',
+        'format': 'json',
+        'formatversion': '2',
+    }
+    ret = set()
+    while True:
+        res = safe_get(
+            API_URL + '?' + urllib.parse.urlencode(params),
+            headers=headers,
+            verbose=False,
+            cooldown=0,
+            controller=controller,
+            rate_limiter=rate_limiter,
+        ).json()
+        if 'error' in res:
+            raise RuntimeError('api error: {}'.format(res['error'].get('info')))
+        for i in res['query']['recentchanges']:
+            titles = [i['title']]
+            # the new name of a moved category
+            if 'target_title' in i.get('logparams', {}):
+                titles.append(i['logparams']['target_title'])
+            for title in titles:
+                ret.add(canonical_url('/Category:' + title.split(':', 1)[-1]))
+        if 'continue' not in res:
+            break
+        params.update(res['continue'])
+    return ret
+
+
+def mark_dirty(root, ret, dirty=None):
+    # clears finish1 of the dirty categories (all of them if dirty is None)
+    # and finish2 of every node above them, so that parse_index refetches
+    # exactly those listings and walks down to them; returns the marked urls
+    marked = set()
+    stack = [(root, ret, [])]
+    while stack:
+        url, node, ancestors = stack.pop()
+        key = canonical_url(url)
+        if dirty is None or key in dirty:
+            node.pop('finish1', None)
+            node.pop('finish2', None)
+            for i in ancestors:
+                i.pop('finish2', None)
+            marked.add(key)
+        for i in node.get('subcategories', []):
+            stack.append((i['url'], i, ancestors + [node]))
+    return marked
+
+
+def crawl(root: str, path: str, filter_function=None, incremental=False):
     ret = load_json_or_none(path) or {}
+    # start time of the last complete crawl, used by incremental runs
+    state_path = os.path.splitext(path)[0] + '.state.json'
+    state = load_json_or_none(state_path) or {}
+    started = datetime.datetime.now(datetime.timezone.utc)
+    refresh = set()
+    if incremental and ret:
+        last = state.get('last_crawled')
+        if last and started - datetime.datetime.fromisoformat(
+            last
+        ) < datetime.timedelta(days=RECENT_CHANGES_DAYS):
+            changed = recent_category_changes(last)
+            refresh = mark_dirty(root, ret, changed)
+            print(
+                f'{len(changed)} categories changed since {last}, '
+                f'{len(refresh)} of them in the tree'
+            )
+        else:
+            # recent changes do not reach back far enough, refetch everything
+            print('no usable last crawl time, refetching all categories')
+            refresh = mark_dirty(root, ret)
+    # the partial tree keeps its finish1/finish2 flags, so a crashed or
+    # killed crawl resumes from the last checkpoint like from a saved one
+    tree_lock = Lock()
+
+    def snapshot():
+        with tree_lock:
+            return json.dumps(ret, ensure_ascii=False, separators=(',', ':'))
+
+    checkpointer = Checkpointer(
+        path,
+        snapshot,
+        interval=CHECKPOINT_SECONDS,
+        progress=lambda: page_count,
+        every=CHECKPOINT_PAGES,
+    )
+    checkpointer.start()
     try:
         parse_index(
             root,
             ret,
             filter_function=filter_function,
+            refresh=refresh,
+            lock=tree_lock,
         )
     except KeyboardInterrupt as e:
         pass
     except requests.RequestException as e:
         traceback.print_exc()
         pass
-    except RuntimeError as e:
-        if (
-            str(e) == 'subcategories count decreased'
-            or str(e) == 'pages count decreased'
-        ):
-            print('skip and save partial result')
-        else:
-            raise e
+    except CountDecreased as e:
+        print(f'{e}, skip and save partial result')
+    finally:
+        print(f'saving to {path}')
+        checkpointer.stop()
+    save_json(tree_to_graph(ret), graph_path(path))
+    if 'finish2' in ret:
+        state['last_crawled'] = started.strftime('%Y-%m-%dT%H:%M:%SZ')
+        save_json(state, state_path)
+    print(
+        'category listings: {calls} fetched, {shared} shared'.format(**listings.stats())
+    )
+
+
+def work(name: str, root: str, filter_function=None):
+    # one of several worker processes sharing WORK_DIR: leases categories
+    # from the frontier, appends their listings to its own jsonl file and
+    # queues their subcategories for whichever worker comes next
+    frontier = Frontier(f'{WORK_DIR}/frontier.db', queue=name)
+    frontier.add([(root, None)])
+    worker_id = default_worker_id()
+
+    def fetch(url):
+        print_debug = debug_printer(url, 0)
+        try:
+            return new_listing(url, print_debug)
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            print_debug('fine. 404 then.', color=ERROR)
+            return {}
+
+    with (
+        open(f'{WORK_DIR}/{name}.{worker_id}.jsonl', 'a', encoding='utf-8') as f,
+        ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor,
+    ):
+        for batch in frontier.iter_leases(worker_id, MAX_WORKERS, poll=5):
+            futures = {executor.submit(fetch, url): url for url, _ in batch}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    listing = future.result()
+                except Exception as e:
+                    print(ERROR + f'Error processing {url}: {str(e)}' + RESET)
+                    frontier.fail(url, str(e))
+                    continue
+                f.write(
+                    json.dumps({'url': url, 'listing': listing}, ensure_ascii=False)
+                    + '\n'
+                )
+                f.flush()
+                os.fsync(f.fileno())
+                if 'finish1' in listing:
+                    # the filters only look at the last two entries of the path
+                    frontier.add(
+                        (i['url'], url)
+                        for i in listing['subcategories']
+                        if not filter_function or filter_function([url, i['url']])
+                    )
+                frontier.done(url)
+    print(name, frontier.stats())
+
+
+def read_listings(name: str) -> dict:
+    listings = {}
+    for path in sorted(glob.glob(f'{WORK_DIR}/{name}.*.jsonl')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line of a killed worker
+                    continue
+                old = listings.get(item['url'])
+                if old is None or 'finish1' not in old:
+                    listings[item['url']] = item['listing']
+    return listings
+
+
+def assemble(url, ret, listings, stk=None, filter_function=None):
+    # rebuilds the nested tree parse_index would have produced
+    stk2 = (stk or []) + [url]
+    if 'pages' not in ret:
+        ret['pages'] = []
+    if 'subcategories' not in ret:
+        ret['subcategories'] = []
+    if filter_function and not filter_function(stk2):
+        ret['finish1'] = True
+        ret['finish2'] = True
+        return
+    listing = listings.get(url)
+    if listing is None or 'finish1' not in listing:
+        return
+    if 'article' in listing:
+        ret['article'] = listing['article']
+    ret['pages'] = listing['pages']
+    ret['subcategories'] = [dict(i) for i in listing['subcategories']]
+    ret['finish1'] = True
+    for i in ret['subcategories']:
+        if i['url'] in stk2:
+            continue
+        assemble(i['url'], i, listings, stk2, filter_function)
+    # a child that is one of its ancestors does not hold up finish2, as in
+    # parse_index
+    if all('finish2' in i or i['url'] in stk2 for i in ret['subcategories']):
+        ret['finish2'] = True
+
+
+def merge_work(name: str, root: str, path: str, filter_function=None):
+    ret = {}
+    assemble(root, ret, read_listings(name), filter_function=filter_function)
     save_json(ret, path)
+    save_json(tree_to_graph(ret), graph_path(path))
 
 
 def filter_func_subjects(stk):
@@ -596,13 +1058,62 @@ def filter_func_attrs(stk):
     return True
 
 
-crawl(
-    '/Category:虚拟人物',
-    'moegirl/crawler/attrs.json',
-    filter_function=filter_func_attrs,
-)
-crawl(
-    '/Category:各地区作品',
-    'moegirl/crawler/subjects.json',
-    filter_function=filter_func_subjects,
-)
+CRAWLS = {
+    'attrs': (
+        '/Category:虚拟人物',
+        'moegirl/crawler/attrs.json',
+        filter_func_attrs,
+    ),
+    'subjects': (
+        '/Category:各地区作品',
+        'moegirl/crawler/subjects.json',
+        filter_func_subjects,
+    ),
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='crawl the moegirl category trees')
+    parser.add_argument(
+        'mode',
+        nargs='?',
+        default='tree',
+        choices=['tree', 'worker', 'merge'],
+        help='tree: single process (default); worker: one of several processes '
+        f'sharing {WORK_DIR}; merge: assemble the workers\' output',
+    )
+    parser.add_argument('--crawl', action='append', choices=list(CRAWLS))
+    parser.add_argument(
+        '--processes', type=int, default=1, help='worker processes to start here'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='tree mode: refetch only categories changed since the last crawl',
+    )
+    args = parser.parse_args()
+    names = args.crawl or list(CRAWLS)
+
+    if args.mode == 'tree':
+        for name in names:
+            crawl(*CRAWLS[name], incremental=args.incremental)
+    elif args.mode == 'worker' and args.processes > 1:
+        procs = [
+            subprocess.Popen(
+                [sys.executable, sys.argv[0], 'worker']
+                + [j for name in names for j in ('--crawl', name)]
+            )
+            for _ in range(args.processes)
+        ]
+        for proc in procs:
+            proc.wait()
+    elif args.mode == 'worker':
+        # politeness limits hold across all workers sharing WORK_DIR
+        rate_limiter = RateLimiter.from_env(
+            f'{WORK_DIR}/limits.db', max_requests_per_second=30, burst=10
+        )
+        for name in names:
+            root, _, filter_function = CRAWLS[name]
+            work(name, root, filter_function)
+    else:
+        for name in names:
+            merge_work(name, *CRAWLS[name])
@@ -0,0 +1,115 @@
+# The category trees in attrs.json and subjects.json repeat a category (or
+# leave an empty stub of it) under every parent that reaches it. Next to
+# each tree the crawler writes <name>.graph.json with every category and
+# page stored once:
+#
+#   {"categories": [{"url", "name", "article", "finish1", "finish2"}, ...],
+#    "pages": [{"name", "url"}, ...],
+#    "subcategories": [[parent, child], ...],
+#    "members": [[category, page], ...]}
+#
+# Ids are list positions, category 0 is the root (it has no name or url)
+# and the edges keep the order of the category listings.
+import os
+from typing import Callable, Iterator
+
+from utils.file import load_json, save_json
+
+NODE_FIELDS = ('url', 'name', 'article', 'finish1', 'finish2')
+
+
+def graph_path(tree_path: str) -> str:
+    return os.path.splitext(tree_path)[0] + '.graph.json'
+
+
+def tree_to_graph(tree: dict) -> dict:
+    categories: list[dict] = []
+    category_ids: dict[str | None, int] = {}
+    pages: list[dict] = []
+    page_ids: dict[str, int] = {}
+    # dicts as ordered sets of edges
+    subcategories: dict[tuple[int, int], None] = {}
+    members: dict[tuple[int, int], None] = {}
+
+    def category_id(node):
+        key = node.get('url')
+        if key not in category_ids:
+            category_ids[key] = len(categories)
+            categories.append({})
+        ret = category_ids[key]
+        # the copies and stubs of a category are merged into one node
+        for field in NODE_FIELDS:
+            if field in node and field not in categories[ret]:
+                categories[ret][field] = node[field]
+        return ret
+
+    stack = [(tree, category_id(tree))]
+    while stack:
+        node, i = stack.pop()
+        for page in node.get('pages', []):
+            if page['url'] not in page_ids:
+                page_ids[page['url']] = len(pages)
+                pages.append({'name': page['name'], 'url': page['url']})
+            members[(i, page_ids[page['url']])] = None
+        children = []
+        for child in node.get('subcategories', []):
+            j = category_id(child)
+            subcategories[(i, j)] = None
+            children.append((child, j))
+        stack.extend(reversed(children))
+    return {
+        'categories': categories,
+        'pages': pages,
+        'subcategories': list(subcategories),
+        'members': list(members),
+    }
+
+
+class CategoryGraph:
+    def __init__(self, data: dict):
+        self.categories: list[dict] = data['categories']
+        self.pages: list[dict] = data['pages']
+        self.subcategories: list[list[int]] = [[] for _ in self.categories]
+        for parent, child in data['subcategories']:
+            self.subcategories[parent].append(child)
+        self.members: list[list[int]] = [[] for _ in self.categories]
+        for category, page in data['members']:
+            self.members[category].append(page)
+        self.ids = {c['name']: i for i, c in enumerate(self.categories) if 'name' in c}
+
+    def find(self, name: str) -> int:
+        return self.ids[name]
+
+    def walk(
+        self, start: int = 0, skip: Callable[[int], bool] | None = None
+    ) -> Iterator[tuple[int, int | None]]:
+        # depth first from start in listing order, each category once;
+        # yields (category, the parent it was reached from). Categories for
+        # which skip returns True are not visited or walked through
+        visited = set()
+        stack: list[tuple[int, int | None]] = [(start, None)]
+        while stack:
+            i, parent = stack.pop()
+            if i in visited or (skip and skip(i)):
+                continue
+            visited.add(i)
+            yield i, parent
+            stack.extend((j, i) for j in reversed(self.subcategories[i]))
+
+    def page_names(self, start: int = 0) -> set[str]:
+        # every page in or below start
+        return {
+            self.pages[p]['name'] for i, _ in self.walk(start) for p in self.members[i]
+        }
+
+
+def load_graph(tree_path: str) -> CategoryGraph:
+    # reads the graph saved next to the tree, converting the tree first if
+    # the graph is missing or older
+    path = graph_path(tree_path)
+    if not os.path.exists(path) or (
+        os.path.exists(tree_path)
+        and os.path.getmtime(tree_path) > os.path.getmtime(path)
+    ):
+        save_json(tree_to_graph(load_json(tree_path)), path)
+    return CategoryGraph(load_json(path))
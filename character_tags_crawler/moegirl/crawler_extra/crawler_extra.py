@@ -1,7 +1,9 @@
+import argparse
 import json
 import os
 import re
 import traceback
+import urllib.parse
 import warnings
 import requests
 from bs4 import BeautifulSoup
@@ -11,9 +13,14 @@ from bs4 import MarkupResemblesLocatorWarning
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
 
-from utils.network import safe_get, title_to_url, DynamicCooldown, RateLimiter
+from utils.network import safe_get, title_to_url, ConcurrencyController, RateLimiter
+from utils.metrics import default_metrics, dump_metrics_from_env
 from utils.file import save_json, chdir_project_root
+from utils.soup import extract_textarea
+from utils.frontier import Frontier, DONE, default_worker_id
+from utils.memo import Memo
 from moegirl.crawler_extra.mwutils import remove_style
+from moegirl.crawler_extra.rawcache import RAW_DIR, RawCache, migrate
 
 chdir_project_root()
 
@@ -65,27 +72,45 @@ if cookies:
         print('Using raw cookies:', cookies)
         headers['Cookie'] = cookies
 
-file_write_lock = Lock()
-dynamic_cooldown = DynamicCooldown()
-rate_limiter = RateLimiter(max_requests_per_second=30)
+# the controller decides how many of the workers may have a request in flight
+MAX_WORKERS = 32
+controller = ConcurrencyController(initial=4, max_window=MAX_WORKERS)
+rate_limiter = RateLimiter(max_requests_per_second=30, burst=10)
 success_count = 0
 success_count_lock = Lock()
+# MOEGIRL_CRAWL_BACKEND=api fetches the wikitext of API_BATCH pages per
+# request through api.php instead of one edit form per page
+BACKEND = os.getenv('MOEGIRL_CRAWL_BACKEND', 'html')
+API_URL = base_url + '/api.php'
+# titles per prop=revisions request, the most the API takes without bot rights
+API_BATCH = 50
+# frontier payload of cached pages to fetch again, see find_stale; kept in
+# the frontier so a refresh that was cut short resumes without --refresh
+REFETCH = {'refetch': True}
+# results of parse() are kept in parse_memo.db by the hash of the wikitext;
+# bump this whenever a change to parse() changes its output
+PARSER_VERSION = 1
 
 
-def gen_cache_path(name):
-    if not name or not name.strip():
-        raise ValueError(f"Invalid name: {name}")
-    name = name.replace("/", "")
-    name = name.replace("\\", "")
-    name = name.replace("?", "")
-    name = name.replace(":", "")
-    name = name.replace("*", "")
-    name = name.replace('"', "")
-    name = name.replace("|", "")
-    name = name.replace("<", "")
-    name = name.replace(">", "")
-    name = f'moegirl/crawler_extra/raw/{name}.txt'
-    return name
+def is_infobox(tname, params):
+    return (
+        "人物信息" in tname
+        or '角色信息' in tname
+        or "替身信息" in tname
+        or '信息栏' in tname
+        or '宠物信息' in tname
+        or '基本信息' in tname
+        or 'Infobox' in tname
+        or tname == 'FlowerKnightGirl'
+        or tname == 'PvZ2植物'
+        or '萌点' in params
+        or '姓名' in params
+        or '本名' in params
+        or '名字' in params
+        or '别名' in params
+        or '声优' in params
+        or '萌属性' in params
+    )
 
 
 def extract_infobox(wikitext):
@@ -96,153 +121,391 @@ def extract_infobox(wikitext):
             continue
         tname = str(i.name).strip()
         params = list(map(lambda x: str(x.name).strip(), i.params))
-        if (
-            "人物信息" in tname
-            or '角色信息' in tname
-            or "替身信息" in tname
-            or '信息栏' in tname
-            or '宠物信息' in tname
-            or '基本信息' in tname
-            or 'Infobox' in tname
-            or tname == 'FlowerKnightGirl'
-            or tname == 'PvZ2植物'
-            or '萌点' in params
-            or '姓名' in params
-            or '本名' in params
-            or '名字' in params
-            or '别名' in params
-            or '声优' in params
-            or '萌属性' in params
-        ):
+        if is_infobox(tname, params):
             # print(i)
             ret.append(str(i))
     return ret
 
 
+# braces inside comments and nowiki do not open templates, pipes inside
+# links do not separate parameters
+template_token_re = re.compile(
+    r'<!--.*?(?:-->|\Z)|<nowiki>.*?(?:</nowiki>|\Z)|\{\{+|\}\}+|\[\[|\]\]|\|',
+    flags=re.DOTALL | re.IGNORECASE,
+)
+
+
+def find_templates(raw):
+    # top-level {{...}} of the page in one pass, as (start, end, positions
+    # of the pipes separating the name and parameters)
+    ret = []
+    # [start, is template (not a {{{argument}}}), pipes, closed templates
+    # inside, open links of the parent]
+    stack = []
+    links = 0
+    for m in template_token_re.finditer(raw):
+        token = m.group()
+        if token[0] == '{':
+            # like MediaWiki, an odd run ends with an argument
+            pos, n = m.start(), len(token)
+            while n >= 2:
+                size = 3 if n == 3 else 2
+                stack.append([pos, size == 2, [], [], links])
+                links = 0
+                pos += size
+                n -= size
+        elif token[0] == '}':
+            pos, n = m.start(), len(token)
+            while stack and n >= 2:
+                start, is_template, pipes, children, links = stack.pop()
+                size = 2 if is_template or n == 2 else 3
+                pos += size
+                n -= size
+                parent = stack[-1][3] if stack else ret
+                if is_template:
+                    parent.append((start, pos, pipes))
+                else:
+                    parent.extend(children)
+        elif token == '[[':
+            links += 1
+        elif token == ']]':
+            links = max(links - 1, 0)
+        elif stack and links == 0:
+            stack[-1][2].append(m.start())
+    # a '{{' that is never closed would swallow the rest of the page, the
+    # templates closed inside it count as top-level ones
+    for frame in stack:
+        ret.extend(frame[3])
+    ret.sort()
+    return ret
+
+
+def param_name(part):
+    # name of a named parameter without the leading pipe, '' for positional
+    return part.split('=', 1)[0].strip() if '=' in part else ''
+
+
 def parse(raw):
-    p = extract_infobox(raw)
-    if len(p) > 0:
-        return p
-    limit = 10
-    for pos in re.finditer(r'\{\{', wikitext):
-        p = extract_infobox(wikitext[pos.start() :])
-        if len(p) > 0:
-            return p
-        limit -= 1
-        if limit <= 0:
-            break
-    root_templates = []
-    cur = 0
-    start = None
-    for i in range(len(raw) - 1):
-        if raw[i : i + 2] == '{{':
-            if cur == 0:
-                start = i
-            cur += 1
-        elif raw[i : i + 2] == '}}':
-            cur -= 1
-            if cur == 0:
-                root_templates.append(raw[start : i + 2])
+    # only templates that look like an infobox go through mwparserfromhell
     ret = []
-    for i in root_templates:
-        l = i.split('\n')
-        for j in range(len(l)):
-            if l[j].strip().startswith('|') and '=' in l[j]:
-                tmp = l[j].split('=')
-                pname = tmp[0].strip()
-                pvalue = '='.join(tmp[1:])
-                if '{' in pname:
-                    # print(pname, pvalue)
-                    pname = remove_style(mwp.parse(pname))
-                    # print(pname)
-                l[j] = f'{pname}={pvalue}'
-        t = '\n'.join(l)
-        ret.extend(extract_infobox(t))
+    for start, end, pipes in find_templates(raw):
+        if len(pipes) < 3:
+            continue
+        template = raw[start:end]
+        bounds = [i - start for i in pipes] + [len(template) - 2]
+        tname = template[2 : bounds[0]].strip()
+        parts = [template[i + 1 : j] for i, j in zip(bounds, bounds[1:])]
+        params = [param_name(i) for i in parts]
+        if not is_infobox(tname, params) and any('{' in i for i in params):
+            # names written with templates, e.g. {{ruby|...}}
+            params = [remove_style(mwp.parse(i)) if '{' in i else i for i in params]
+            l = template.split('\n')
+            for j in range(len(l)):
+                if l[j].strip().startswith('|') and '=' in l[j]:
+                    pname, pvalue = l[j].strip()[1:].split('=', 1)
+                    if '{' in pname:
+                        pname = remove_style(mwp.parse(pname.strip()))
+                        l[j] = f'|{pname}={pvalue}'
+            template = '\n'.join(l)
+        if is_infobox(tname, params):
+            ret.extend(extract_infobox(template))
     return ret
 
 
-def crawl(name, bar):
+class PageError(Exception):
+    # the page itself is unusable, retrying will not help
+    pass
+
+
+def count_success(bar):
     global success_count
-    cache_path = gen_cache_path(name)
-    if os.path.exists(cache_path):
+    bar.set_postfix_str(default_metrics.summary(), refresh=False)
+    with success_count_lock:
+        success_count += 1
+        if success_count % 1000 == 0:
+            bar.write(
+                f'Progress: {success_count} items successfully crawled, '
+                f'{controller.stats()}'
+            )
+
+
+def crawl(name, bar, refetch=False):
+    if name in cache and not refetch:
         return
     url = base_url + "/index.php?title={}&action=edit".format(title_to_url(name))
-    try:
-        response = safe_get(url, bar, headers=headers, dynamic_cooldown=dynamic_cooldown, rate_limiter=rate_limiter, timeout=30)
+    response = safe_get(
+        url,
+        bar,
+        headers=headers,
+        verbose=False,
+        cooldown=0,
+        jitter=0,
+        controller=controller,
+        rate_limiter=rate_limiter,
+        timeout=30,
+    )
+    if response is None:
+        raise requests.exceptions.RequestException('No response from server')
+    res = response.text
+    if not res or len(res) < 100:
+        raise PageError(f'Empty or too short response (length: {len(res)})')
+    t = extract_textarea(res)
+    if t is None:
+        raise PageError('No textarea found in response')
+    if not t:
+        raise PageError('Textarea found but empty')
+
+    cache.write(name, t)
+    count_success(bar)
+
+
+def api_query(params, bar):
+    # yields the `query` part of each response, following continuations
+    params = dict(params, format='json', formatversion='2')
+    while True:
+        response = safe_get(
+            API_URL + '?' + urllib.parse.urlencode(params),
+            bar,
+            headers=headers,
+            verbose=False,
+            cooldown=0,
+            jitter=0,
+            controller=controller,
+            rate_limiter=rate_limiter,
+            timeout=60,
+        )
         if response is None:
-            bar.write(f'{name} -> No response from server')
-            return
-        res = response.text
-        if not res or len(res) < 100:
-            bar.write(f'{name} -> Empty or too short response (length: {len(res)})')
+            raise requests.exceptions.RequestException('No response from server')
+        res = response.json()
+        if 'error' in res:
+            raise requests.exceptions.RequestException(
+                'api error: {}'.format(res['error'].get('info'))
+            )
+        yield res.get('query', {})
+        if 'continue' not in res:
             return
-        soup = BeautifulSoup(res, features="html.parser")
-        textarea = soup.find('textarea')
-        if textarea is None:
-            bar.write(f'{name} -> No textarea found in response')
-            return
-        if not textarea.contents or len(textarea.contents) == 0:
-            bar.write(f'{name} -> Textarea found but empty')
-            return
-        t = textarea.contents[0]  # type: ignore
-
-        with file_write_lock:
-            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-            open(cache_path, 'w', encoding='utf8').write(t)
-        
-        with success_count_lock:
-            success_count += 1
-            if success_count % 1000 == 0:
-                bar.write(f'Progress: {success_count} items successfully crawled')
-    except requests.exceptions.Timeout as e:
-        bar.write(f'{name} -> Timeout error: {str(e)}')
-    except requests.exceptions.ConnectionError as e:
-        bar.write(f'{name} -> Connection error: {str(e)}')
-    except requests.exceptions.RequestException as e:
-        bar.write(f'{name} -> Request error: {str(e)}')
-    except Exception as e:
-        bar.write(f'{name} -> Error: {str(e)}')
-        traceback.print_exc()
-
-
-char_index = json.load(open("moegirl/preprocess/char_index.json", encoding="utf-8"))
-
-with ThreadPoolExecutor(max_workers=8) as executor:
-    futures = {}
-    with tqdm(char_index) as bar:
-        for i in bar:
-            future = executor.submit(crawl, i, bar)
-            futures[future] = i
-        
-        for future in as_completed(futures):
-            name = futures[future]
-            try:
-                future.result()
-            except Exception as e:
-                bar.write(f'Error processing {name}: {str(e)}')
-                traceback.print_exc()
-
-extra_info = {}
-bar = tqdm(char_index)
-for idx, name in enumerate(bar):
-    try:
-        cache_path = gen_cache_path(name)
-        if os.path.exists(cache_path):
-            with open(cache_path, encoding="utf-8") as f:
-                wikitext = f.read()
-        else:
+        params.update(res['continue'])
+
+
+def query_pages(params, bar):
+    # pages of a titles= query by the title each requested name resolves to
+    # after normalization and redirects
+    aliases = {}
+    pages = {}
+    for query in api_query(dict(params, redirects='1'), bar):
+        for i in query.get('normalized', []) + query.get('redirects', []):
+            aliases[i['from']] = i['to']
+        for page in query.get('pages', []):
+            # a continued response repeats the pages it had no room for
+            if page.get('revisions') or page['title'] not in pages:
+                pages[page['title']] = page
+    ret = {}
+    for name in params['titles'].split('|'):
+        title = name
+        seen = set()
+        while title in aliases and title not in seen:
+            seen.add(title)
+            title = aliases[title]
+        page = pages.get(title)
+        if page is not None and not page.get('missing') and not page.get('invalid'):
+            ret[name] = page
+    return ret
+
+
+def fetch_revisions(names, bar):
+    # latest revision of each page in one prop=revisions request (several
+    # if the response is cut and continued); maps every name to
+    # {'content', 'revid', 'timestamp'} or to the PageError for it
+    params = {
+        'action': 'query',
+        'prop': 'revisions',
+        'rvprop': 'ids|timestamp|content',
+        'rvslots': 'main',
+        'titles': '|'.join(names),
+    }
+    pages = query_pages(params, bar)
+    ret = {}
+    for name in names:
+        page = pages.get(name)
+        if page is None:
+            ret[name] = PageError('Page does not exist')
             continue
-        p = parse(wikitext)
-        if p and len(p) > 0:
-            extra_info[name] = p
-        else:
-            bar.write(f'No output: {name}')
-    except KeyboardInterrupt as e:
-        break
-    except Exception as e:
-        bar.write(f'Error processing {name}: {str(e)}')
-        traceback.print_exc()
-bar.close()
-print('Valid extra:', len(extra_info))
-os.makedirs(os.path.dirname('moegirl/crawler_extra/extra_info.json'), exist_ok=True)
-save_json(extra_info, 'moegirl/crawler_extra/extra_info.json')
+        if not page.get('revisions'):
+            ret[name] = PageError('No revision in response')
+            continue
+        rev = page['revisions'][0]
+        content = (
+            rev['slots']['main']['content'] if 'slots' in rev else rev.get('content')
+        )
+        if not content:
+            ret[name] = PageError('Empty wikitext')
+            continue
+        ret[name] = {
+            'content': content,
+            'revid': rev['revid'],
+            'timestamp': rev['timestamp'],
+        }
+    return ret
+
+
+def fetch_lastrevids(names, bar):
+    # current revision id of each existing page, without the content
+    params = {'action': 'query', 'prop': 'info', 'titles': '|'.join(names)}
+    return {name: page['lastrevid'] for name, page in query_pages(params, bar).items()}
+
+
+def find_stale(names):
+    # cached pages whose revision moved on, or that were fetched from the
+    # edit form and have no revision recorded; pages gone from the wiki
+    # keep their cached text
+    chunks = [names[i : i + API_BATCH] for i in range(0, len(names), API_BATCH)]
+    ret = set()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with tqdm(total=len(names), desc='revisions') as bar:
+            futures = {
+                executor.submit(fetch_lastrevids, chunk, bar): chunk for chunk in chunks
+            }
+            for future in as_completed(futures):
+                revids = future.result()
+                for name in futures[future]:
+                    rev = cache.revision(name)
+                    if name in revids and (rev is None or rev['revid'] != revids[name]):
+                        ret.add(name)
+                bar.update(len(futures[future]))
+    return ret
+
+
+def crawl_batch(names, bar, refetch=()):
+    # API counterpart of crawl for up to API_BATCH names; returns the error
+    # of each name, None where the page was cached
+    names = [name for name in names if name not in cache or name in refetch]
+    errors = {name: PageError('Invalid name') for name in names if not name.strip()}
+    names = [name for name in names if name not in errors]
+    if names:
+        for name, res in fetch_revisions(names, bar).items():
+            if isinstance(res, Exception):
+                errors[name] = res
+                continue
+            cache.write(name, res['content'], res['revid'], res['timestamp'])
+            count_success(bar)
+    return errors
+
+
+def settle(name, error, bar):
+    # errors of the page itself are final, network errors are retried
+    bar.update()
+    if error is None:
+        frontier.done(name)
+    elif isinstance(error, PageError):
+        bar.write(f'{name} -> {str(error)}')
+        frontier.fail(name, str(error), retry=False)
+    elif isinstance(error, requests.exceptions.Timeout):
+        bar.write(f'{name} -> Timeout error: {str(error)}')
+        frontier.fail(name, str(error))
+    elif isinstance(error, requests.exceptions.ConnectionError):
+        bar.write(f'{name} -> Connection error: {str(error)}')
+        frontier.fail(name, str(error))
+    elif isinstance(error, requests.exceptions.RequestException):
+        bar.write(f'{name} -> Request error: {str(error)}')
+        frontier.fail(name, str(error))
+    else:
+        bar.write(f'{name} -> Error: {str(error)}')
+        traceback.print_exception(error)
+        frontier.fail(name, str(error), retry=False)
+
+
+if __name__ == '__main__':
+    dump_metrics_from_env()
+    cache = RawCache()
+
+    parser = argparse.ArgumentParser(description='fetch and parse character wikitext')
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='refetch the cached pages edited since they were fetched (uses api.php)',
+    )
+    args = parser.parse_args()
+
+    char_index = json.load(open("moegirl/preprocess/char_index.json", encoding="utf-8"))
+    if len(cache) == 0 and os.path.isdir(RAW_DIR):
+        # checkouts from before raw.pack
+        print(f'imported {migrate(char_index, cache)} pages from {RAW_DIR}')
+
+    # pages already in the cache count as done; `python utils/frontier.py
+    # moegirl/crawler_extra/frontier.db` lists what is left and what failed
+    frontier = Frontier('moegirl/crawler_extra/frontier.db', queue='wikitext')
+    frontier.add(
+        (name for name in char_index if name.strip() and name in cache),
+        state=DONE,
+    )
+    frontier.add(char_index)
+    if args.refresh:
+        cached = [name for name in char_index if name.strip() and name in cache]
+        stale = find_stale(cached)
+        print(f'{len(stale)} of {len(cached)} cached pages changed')
+        frontier.requeue(stale, payload=REFETCH)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with tqdm(total=frontier.remaining()) as bar:
+            # only the API reports revisions, which the next refresh compares
+            if BACKEND == 'api' or args.refresh:
+                batches = frontier.iter_leases(
+                    default_worker_id(), MAX_WORKERS * API_BATCH * 2
+                )
+                for batch in batches:
+                    names = [name for name, _ in batch]
+                    refetch = {name for name, payload in batch if payload == REFETCH}
+                    chunks = [
+                        names[i : i + API_BATCH]
+                        for i in range(0, len(names), API_BATCH)
+                    ]
+                    futures = {
+                        executor.submit(crawl_batch, chunk, bar, refetch): chunk
+                        for chunk in chunks
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            errors = future.result()
+                        except Exception as e:
+                            errors = {name: e for name in futures[future]}
+                        for name in futures[future]:
+                            settle(name, errors.get(name), bar)
+            else:
+                batches = frontier.iter_leases(default_worker_id(), MAX_WORKERS * 8)
+                for batch in batches:
+                    futures = {
+                        executor.submit(crawl, name, bar, payload == REFETCH): name
+                        for name, payload in batch
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                            error = None
+                        except Exception as e:
+                            error = e
+                        settle(futures[future], error, bar)
+            bar.write(str(frontier.stats()))
+
+    # pages parsed in an earlier run come from the memo, the others are
+    # parsed in worker processes, see utils/parallel.py
+    names = [name for name in char_index if name.strip() and name in cache]
+    extra_info = {}
+    memo = Memo('moegirl/crawler_extra/parse_memo.db', 'infobox', PARSER_VERSION)
+    results = memo.map(parse, names, cache.read)
+    bar = tqdm(results, total=len(names))
+    try:
+        for name, p, error in bar:
+            if error:
+                bar.write(f'Error processing {name}:\n{error}')
+            elif p and len(p) > 0:
+                extra_info[name] = p
+            else:
+                bar.write(f'No output: {name}')
+    except KeyboardInterrupt:
+        pass
+    bar.close()
+    memo.close()
+    cache.close()
+    print('Valid extra:', len(extra_info))
+    os.makedirs(os.path.dirname('moegirl/crawler_extra/extra_info.json'), exist_ok=True)
+    save_json(extra_info, 'moegirl/crawler_extra/extra_info.json')
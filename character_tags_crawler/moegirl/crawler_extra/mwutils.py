@@ -1,16 +1,15 @@
 import re
-from typing import Any
+from typing import Any, Callable
 import warnings
 import traceback
 import mwparserfromhell as mwp
 from bs4 import BeautifulSoup
-import opencc
 
-converter = opencc.OpenCC("t2s.json")
+from utils.opencc_conv import t2s
 
 
 def conv(t: str) -> str:
-    return converter.convert(t)
+    return t2s(t)
 
 
 def unique(l: list[Any]) -> list[Any]:
@@ -128,7 +127,257 @@ def calc_zodiac(month: int, day: int) -> str:
     raise ValueError(f"Invalid month/day: {month}/{day}")
 
 
+# lowercased template name -> handler(code, name, aggressive) returning the
+# text of the template
+template_handlers: dict[str, Callable[..., list[str]]] = {}
+# (prefix or substring, is prefix, handler) for the names not in
+# template_handlers, tried in order
+template_patterns: list[tuple[str, bool, Callable[..., list[str]]]] = []
+
+
+def template_handler(*names, prefixes=(), contains=()):
+    # registers the decorated function for templates named `names`, or whose
+    # name starts with one of `prefixes` or contains one of `contains`
+    def register(fn):
+        for name in names:
+            template_handlers[name] = fn
+        template_patterns.extend((i, True, fn) for i in prefixes)
+        template_patterns.extend((i, False, fn) for i in contains)
+        return fn
+
+    return register
+
+
+def find_template_handler(name: str) -> Callable[..., list[str]] | None:
+    handler = template_handlers.get(name)
+    if handler is not None:
+        return handler
+    for pattern, is_prefix, handler in template_patterns:
+        if name.startswith(pattern) if is_prefix else pattern in name:
+            return handler
+    return None
+
+
 # pyright: reportAttributeAccessIssue=none
+@template_handler(
+    "cate",
+    "黑幕",
+    '黒幕',
+    "heimu",
+    "假黑幕",
+    "jk",
+    "胡话",
+    "注解",
+    "lj",
+    "彩幕",
+    "彩色幕",
+    "模糊",
+    "文字模糊",
+    "dead",
+    "small",
+    "citation needed",
+    "示亡",
+    "已故标注",
+    "已故人物标注",
+    "font",
+    "注",
+    "ljr",
+    "黑雾",
+    "block",
+    "texthover",
+    'hoverinline',
+    "魔女文字",
+    "writing-mode",
+    "填空幕",
+    "toggle 内联按钮",
+    "文字外发光",
+    "tja",
+    '瞳色',
+    '发色',
+    'eye color',
+    'hair color',
+    'eye_color',
+    'hair_color',
+    'rainbow text',
+    'background color',
+    'ac',
+    '模糊文字',
+    '舰c',
+    '荧光笔',
+    'plain link',
+    '东方名词',
+    '碧蓝航线links',
+    'center',
+    '星座分类',
+    prefixes=("lang-", "photrans", "文字描边"),
+)
+def first_param(code, name, aggressive):
+    if len(code.params) >= 1:
+        return extract_text(code.params[0].value)
+    warnings.warn("template " + name + " has fewer params than expected:\n" + str(code))
+    return []
+
+
+@template_handler(
+    "切换显示",
+    "color",
+    "coloredlink",
+    "colorlink",
+    "lang",
+    "gradient_text",
+    "cj",
+    '#invoke:战舰少女',
+)
+def second_param(code, name, aggressive):
+    return extract_text(code.get(2).value)
+
+
+@template_handler("萌点")
+def moe_points(code, name, aggressive):
+    return [multisplit(str(i.value))[0] for i in code.params]
+
+
+@template_handler("ruby", "rubyh")
+def ruby(code, name, aggressive):
+    ret = extract_text(code.get(1).value)
+    if aggressive:
+        ret.extend(extract_text(code.get(2).value))
+    return ret
+
+
+@template_handler("username", "0", "fact")
+def optional_first_param(code, name, aggressive):
+    if code.has(1):
+        return extract_text(code.get(1).value)
+    return []
+
+
+@template_handler("rubya")
+def rubya(code, name, aggressive):
+    return [multisplit(str(i.value))[0] for i in code.params if i.name != "lang"]
+
+
+@template_handler("hide")
+def hide(code, name, aggressive):
+    if code.has(1) and code.get(1) == "show":
+        if code.has(2):
+            return extract_text(code.get(2).value)
+        return extract_text(code.get("内容").value)
+    if code.has(1):
+        return extract_text(code.get(1).value)
+    return extract_text(code.get("内容").value)
+
+
+@template_handler("日本人名", "jpn")
+def japanese_name(code, name, aggressive):
+    tmp = ""
+    if code.has(1):
+        tmp += "".join(extract_text(code.get(1).value))
+    if code.has(3):
+        tmp += "".join(extract_text(code.get(3).value))
+    return [tmp]
+
+
+@template_handler("gup", "少战")
+def second_or_first_param(code, name, aggressive):
+    if code.has(2):
+        return extract_text(code.get(2).value)
+    return extract_text(code.get(1).value)
+
+
+@template_handler("link")
+def link(code, name, aggressive):
+    ret = []
+    for i in code.params:
+        if i.name == "char":
+            continue
+        ret.extend(extract_text(i.value))
+    return ret
+
+
+@template_handler("toggle", "toggle2")
+def toggle(code, name, aggressive):
+    return extract_text(code.get("content").value)
+
+
+@template_handler("hideinline")
+def hideinline(code, name, aggressive):
+    if code.has_param("内容"):
+        return extract_text(code.get("内容").value)
+    if code.get(1).value == "show":
+        return extract_text(code.get(3).value)
+    return extract_text(code.get(2).value)
+
+
+@template_handler("astrology", '星座')
+def astrology(code, name, aggressive):
+    month = None
+    day = None
+    try:
+        if len(code.params) == 2:
+            month = int(str(code.get(1).value))
+            day = int(str(code.get(2).value))
+        elif len(code.params) == 3:
+            if str(code.get(3).value).strip() == '':
+                month = int(str(code.get(1).value))
+                day = int(str(code.get(2).value))
+            else:
+                month = int(str(code.get(2).value))
+                day = int(str(code.get(3).value))
+        else:
+            warnings.warn("Invalid astrology template:\n" + str(code))
+    except Exception:
+        warnings.warn("Invalid astrology template:\n" + str(code))
+    if month is not None and day is not None:
+        return [calc_zodiac(month, day)]
+    return []
+
+
+@template_handler('折叠属性')
+def folded_attrs(code, name, aggressive):
+    return extract_text(code.get('div').value)
+
+
+@template_handler('moe-hover')
+def moe_hover(code, name, aggressive):
+    return extract_text(code.get('hover1').value)
+
+
+@template_handler(
+    'ref',
+    "refn",
+    "#invoke:housamo",
+    "ps",
+    "note",
+    "来源请求",
+    "w",
+    "·",
+    "bilibililink",
+    "pg",
+    "zh-hant",
+    "regionicon",
+    "图片外链",
+    "color_block/wl",
+    "space",
+    "nbsp",
+    'bilibiliup',
+    'colorbox',
+    prefixes=('#switch:',),
+    contains=('注释',),
+)
+def no_text(code, name, aggressive):
+    return []
+
+
+# @template_handler('birthday')
+# def birthday(code, name, aggressive):
+#     for i in code.params:
+#         if i.name.strip() == 'ft':
+#             continue
+#         return extract_text(i.value)
+#     return []
+
+
 def extract_text(
     code, strict_root=False, aggressive=False, wikilink=False, multiline_mode=False
 ) -> list[str]:
@@ -136,187 +385,9 @@ def extract_text(
     try:
         if isinstance(code, mwp.nodes.template.Template):
             name = code.name.lower().strip()
-            if (
-                name == "cate"
-                or name == "黑幕"
-                or name == '黒幕'
-                or name == "heimu"
-                or name == "假黑幕"
-                or name == "jk"
-                or name == "胡话"
-                or name == "注解"
-                or name == "lj"
-                or name == "彩幕"
-                or name == "彩色幕"
-                or name == "模糊"
-                or name == "文字模糊"
-                or name == "dead"
-                or name == "small"
-                or name == "citation needed"
-                or name == "示亡"
-                or name == "已故标注"
-                or name == "已故人物标注"
-                or name.startswith("lang-")
-                or name == "font"
-                or name == "注"
-                or name == "ljr"
-                or name == "黑雾"
-                or name == "block"
-                or name == "texthover"
-                or name == 'hoverinline'
-                or name.startswith("photrans")
-                or name == "魔女文字"
-                or name.startswith("文字描边")
-                or name == "writing-mode"
-                or name == "文字模糊"
-                or name == "填空幕"
-                or name == "toggle 内联按钮"
-                or name == "文字外发光"
-                or name == "tja"
-                or name == '瞳色'
-                or name == '发色'
-                or name == 'eye color'
-                or name == 'hair color'
-                or name == 'eye_color'
-                or name == 'hair_color'
-                or name == 'rainbow text'
-                or name == 'background color'
-                or name == 'ac'
-                or name == '模糊文字'
-                or name == '舰c'
-                or name == '荧光笔'
-                or name == 'plain link'
-                or name == '东方名词'
-                or name == '碧蓝航线links'
-                or name == 'center'
-                or name == '星座分类'
-            ):
-                if len(code.params) >= 1:
-                    ret.extend(extract_text(code.params[0].value))
-                else:
-                    warnings.warn(
-                        "template "
-                        + name
-                        + " has fewer params than expected:\n"
-                        + str(code)
-                    )
-            elif (
-                name == "切换显示"
-                or name == "color"
-                or name == "coloredlink"
-                or name == "colorlink"
-                or name == "lang"
-                or name == "gradient_text"
-                or name == "cj"
-                or name == '#invoke:战舰少女'
-            ):
-                ret.extend(extract_text(code.get(2).value))
-            elif name == "萌点":
-                for i in code.params:
-                    ret.append(multisplit(str(i.value))[0])
-            elif name == "ruby" or name == "rubyh":
-                ret.extend(extract_text(code.get(1).value))
-                if aggressive:
-                    ret.extend(extract_text(code.get(2).value))
-            elif name == "username" or name == "0" or name == "fact":
-                if code.has(1):
-                    ret.extend(extract_text(code.get(1).value))
-            elif name == "rubya":
-                for i in code.params:
-                    if i.name == "lang":
-                        continue
-                    ret.append(multisplit(str(i.value))[0])
-            elif name == "hide":
-                if code.has(1) and code.get(1) == "show":
-                    if code.has(2):
-                        ret.extend(extract_text(code.get(2).value))
-                    else:
-                        ret.extend(extract_text(code.get("内容").value))
-                else:
-                    if code.has(1):
-                        ret.extend(extract_text(code.get(1).value))
-                    else:
-                        ret.extend(extract_text(code.get("内容").value))
-            elif name == "日本人名" or name == "jpn":
-                tmp = ""
-                if code.has(1):
-                    tmp += "".join(extract_text(code.get(1).value))
-                if code.has(3):
-                    tmp += "".join(extract_text(code.get(3).value))
-                ret.append(tmp)
-            elif name == "gup" or name == "少战":
-                if code.has(2):
-                    ret.extend(extract_text(code.get(2).value))
-                else:
-                    ret.extend(extract_text(code.get(1).value))
-            elif name == "link":
-                for i in code.params:
-                    if i.name == "char":
-                        continue
-                    ret.extend(extract_text(i.value))
-            elif name == "toggle" or name == "toggle2":
-                ret.extend(extract_text(code.get("content").value))
-            elif name == "hideinline":
-                if code.has_param("内容"):
-                    ret.extend(extract_text(code.get("内容").value))
-                else:
-                    if code.get(1).value == "show":
-                        ret.extend(extract_text(code.get(3).value))
-                    else:
-                        ret.extend(extract_text(code.get(2).value))
-            elif name == "astrology" or name == '星座':
-                month = None
-                day = None
-                try:
-                    if len(code.params) == 2:
-                        month = int(str(code.get(1).value))
-                        day = int(str(code.get(2).value))
-                    elif len(code.params) == 3:
-                        if str(code.get(3).value).strip() == '':
-                            month = int(str(code.get(1).value))
-                            day = int(str(code.get(2).value))
-                        else:
-                            month = int(str(code.get(2).value))
-                            day = int(str(code.get(3).value))
-                    else:
-                        warnings.warn("Invalid astrology template:\n" + str(code))
-                except Exception:
-                    warnings.warn("Invalid astrology template:\n" + str(code))
-                if month is not None and day is not None:
-                    ret.append(calc_zodiac(month, day))
-            elif name == '折叠属性':
-                ret.extend(extract_text(code.get('div').value))
-            elif name == 'moe-hover':
-                ret.extend(extract_text(code.get('hover1').value))
-            elif (
-                '注释' in name
-                or name == 'ref'
-                or name == "refn"
-                or name == "#invoke:housamo"
-                or name == "ps"
-                or name == "note"
-                or name == "来源请求"
-                or name == "w"
-                or name == "·"
-                or name == "bilibililink"
-                or name == "pg"
-                or name == "zh-hant"
-                or name == "regionicon"
-                or name == "图片外链"
-                or name == "color_block/wl"
-                or name == "space"
-                or name == "nbsp"
-                or name == 'bilibiliup'
-                or name == 'colorbox'
-                or name.startswith('#switch:')
-            ):
-                pass
-            # elif name == 'birthday':
-            #     for i in code.params:
-            #         if i.name.strip() == 'ft':
-            #             continue
-            #         ret.extend(extract_text(i.value))
-            #         break
+            handler = find_template_handler(name)
+            if handler is not None:
+                ret.extend(handler(code, name, aggressive))
             elif len(code.params) == 0:
                 pass
             else:
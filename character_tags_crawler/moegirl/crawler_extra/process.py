@@ -1,3 +1,4 @@
+import argparse
 import json
 import traceback
 from typing import Optional
@@ -8,6 +9,8 @@ from bs4 import MarkupResemblesLocatorWarning
 import re
 
 from utils.file import save_json, save_json_pretty, chdir_project_root
+from utils.memo import Memo, file_digest
+from utils.parallel import check_workers
 from moegirl.crawler_extra.mwutils import *
 
 chdir_project_root()
@@ -15,6 +18,10 @@ chdir_project_root()
 warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning, module="bs4")
 # warnings.simplefilter("always", UserWarning)
 
+# loaded here rather than under __main__, parse() runs in worker processes
+ATTR_INDEX = "moegirl/preprocess/attr_index.json"
+attrs = set(json.load(open(ATTR_INDEX, encoding="utf-8")))
+
 
 def parse_tab_image(val, prefix=""):
     ret = []
@@ -123,7 +130,6 @@ def parse_image_alt(result, pname, pvalue):
 
 
 def parse_moe(result, pname, pvalue):
-    global attrs
     val = conv(remove_html(str(pvalue)))
     # print(val)
     res = extract_text(mwp.parse(val), strict_root=True, aggressive=True, wikilink=True)
@@ -707,6 +713,13 @@ def parse_zodiac(result, pname, pvalue):
 # info_name_stats = {}
 
 
+# results of parse() are kept in parse_memo.db by the hash of the infobox;
+# bump this whenever a change to the parse functions changes their output.
+# The memo version also includes the hash of attr_index.json, which
+# parse_moe reads
+PARSER_VERSION = 1
+
+
 # pyright: reportAttributeAccessIssue=none
 def parse(infobox):
     wikicode = mwp.parse(infobox).get(0)
@@ -776,28 +789,51 @@ def parse(infobox):
     return result
 
 
-attrs = json.load(open("moegirl/preprocess/attr_index.json", encoding="utf-8"))
-attrs = set(attrs)
-extra = json.load(open("moegirl/crawler_extra/extra_info.json", encoding="utf-8"))
-out = {}
-
-idx = 0
-bar = tqdm(extra.items())
-for k, v in bar:
-    bar.set_description(k)
-    assert len(v) > 0
-    # if len(v) > 1:
-    #     print('Multiple infoboxes for', k)
-    #     for i in v:
-    #         print(repr(i[:10]), end=' ')
-    #     print()
-    infobox = v[0]
-    out[k] = parse(infobox)
-
-# for k, v in sorted(info_key_stats.items(), key=lambda x: x[1], reverse=True)[:100]:
-#     print(k, v)
-# for k, v in sorted(info_name_stats.items(), key=lambda x: x[1], reverse=True)[:100]:
-#     print(k, v)
-
-print(f'Valid size: {len(out)} / {len(extra)}')
-save_json(out, "moegirl/crawler_extra/extra_processed.json")
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parse the infoboxes in extra_info')
+    parser.add_argument(
+        '--check-workers',
+        type=int,
+        metavar='N',
+        help='parse the first N infoboxes here and in forkserver workers, '
+        'report differences and exit',
+    )
+    args = parser.parse_args()
+
+    extra = json.load(open("moegirl/crawler_extra/extra_info.json", encoding="utf-8"))
+    out = {}
+    if args.check_workers:
+        sample = list(extra.items())[: args.check_workers]
+        differ = check_workers(parse, [v[0] for _, v in sample])
+        for i in differ:
+            print('Workers parse differently:', sample[i][0])
+        print(f'{len(differ)} of {len(sample)} infoboxes differ')
+        exit(1 if differ else 0)
+
+    for k, v in extra.items():
+        assert len(v) > 0
+        # if len(v) > 1:
+        #     print('Multiple infoboxes for', k)
+        #     for i in v:
+        #         print(repr(i[:10]), end=' ')
+        #     print()
+    # infoboxes parsed in an earlier run come from the memo, the others are
+    # parsed in worker processes, see utils/parallel.py
+    version = f'{PARSER_VERSION}-{file_digest(ATTR_INDEX)}'
+    memo = Memo('moegirl/crawler_extra/parse_memo.db', 'process', version)
+    results = memo.map(parse, list(extra), lambda k: extra[k][0])
+    bar = tqdm(results, total=len(extra))
+    for k, result, error in bar:
+        if error:
+            bar.write(f'Error processing {k}:\n{error}')
+            continue
+        out[k] = result
+    memo.close()
+
+    # for k, v in sorted(info_key_stats.items(), key=lambda x: x[1], reverse=True)[:100]:
+    #     print(k, v)
+    # for k, v in sorted(info_name_stats.items(), key=lambda x: x[1], reverse=True)[:100]:
+    #     print(k, v)
+
+    print(f'Valid size: {len(out)} / {len(extra)}')
+    save_json(out, "moegirl/crawler_extra/extra_processed.json")
@@ -0,0 +1,110 @@
+# Wikitext of the character pages, in one pack file (utils/pack.py) keyed
+# by the exact title from char_index, with the revision the text was
+# fetched at as record metadata. Pages fetched from the edit form have no
+# revision. Older checkouts kept one raw/{name}.txt per page plus
+# raw/revisions.jsonl; `python moegirl/crawler_extra/rawcache.py migrate`
+# imports them.
+import argparse
+import json
+import os
+
+from utils.file import chdir_project_root
+from utils.pack import Pack
+
+PACK_PATH = 'moegirl/crawler_extra/raw.pack'
+RAW_DIR = 'moegirl/crawler_extra/raw'
+
+
+def gen_cache_path(name, raw_dir=RAW_DIR):
+    # file of a page in the old raw/ layout
+    if not name or not name.strip():
+        raise ValueError(f"Invalid name: {name}")
+    name = name.replace("/", "")
+    name = name.replace("\\", "")
+    name = name.replace("?", "")
+    name = name.replace(":", "")
+    name = name.replace("*", "")
+    name = name.replace('"', "")
+    name = name.replace("|", "")
+    name = name.replace("<", "")
+    name = name.replace(">", "")
+    name = f'{raw_dir}/{name}.txt'
+    return name
+
+
+class RawCache:
+    def __init__(self, path: str = PACK_PATH):
+        self.pack = Pack(path)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.pack
+
+    def __len__(self) -> int:
+        return len(self.pack)
+
+    def read(self, name: str) -> str | None:
+        data = self.pack.get(name)
+        return None if data is None else data.decode('utf-8')
+
+    def write(
+        self,
+        name: str,
+        text: str,
+        revid: int | None = None,
+        timestamp: str | None = None,
+    ):
+        meta = {'revid': revid, 'timestamp': timestamp} if revid is not None else None
+        self.pack.put(name, text.encode('utf-8'), meta)
+        # the frontier marks the page done right after this
+        self.pack.flush()
+
+    def revision(self, name: str) -> dict | None:
+        return self.pack.meta(name)
+
+    def close(self):
+        self.pack.close()
+
+
+def migrate(names, cache: RawCache, raw_dir: str = RAW_DIR) -> int:
+    # imports the pages of `names` found in raw_dir that the cache does not
+    # have yet; raw_dir is left as it is
+    revisions = {}
+    index_path = os.path.join(raw_dir, 'revisions.jsonl')
+    if os.path.exists(index_path):
+        with open(index_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                revisions[entry['name']] = entry
+    imported = 0
+    for name in names:
+        if not name.strip() or name in cache:
+            continue
+        file_path = gen_cache_path(name, raw_dir)
+        if not os.path.exists(file_path):
+            continue
+        with open(file_path, encoding='utf-8') as f:
+            text = f.read()
+        rev = revisions.get(name, {})
+        cache.write(name, text, rev.get('revid'), rev.get('timestamp'))
+        imported += 1
+    return imported
+
+
+if __name__ == '__main__':
+    chdir_project_root()
+    parser = argparse.ArgumentParser(description='manage the raw wikitext pack')
+    parser.add_argument('command', choices=['migrate'])
+    parser.add_argument(
+        '--names',
+        default='moegirl/preprocess/char_index.json',
+        help='titles to look up in the old raw/ directory',
+    )
+    args = parser.parse_args()
+
+    names = json.load(open(args.names, encoding='utf-8'))
+    cache = RawCache()
+    print(f'imported {migrate(names, cache)} pages into {PACK_PATH}')
+    cache.close()
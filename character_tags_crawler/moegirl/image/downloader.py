@@ -9,10 +9,18 @@ from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
 from tqdm import tqdm
 import PIL.Image as Image
 
-from utils.file import chdir_project_root
-from utils.network import safe_download, safe_get, title_to_url, DynamicCooldown
+from utils.file import chdir_project_root, DownloadManifest
+from utils.network import (
+    safe_download,
+    safe_get,
+    title_to_url,
+    DynamicCooldown,
+    RateLimiter,
+)
+from utils.metrics import default_metrics, dump_metrics_from_env
 
 chdir_project_root()
+dump_metrics_from_env()
 
 warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning, module="bs4")
 warnings.simplefilter("always", UserWarning)
@@ -46,6 +54,8 @@ dynamic_cooldown = DynamicCooldown(
     decrease_factor=0.95,
     jitter=0.3
 )
+# api.php lookups and the image host each get their own bucket
+rate_limiter = RateLimiter(max_requests_per_second=10, burst=5)
 
 cookies = os.getenv("MOEGIRL_COOKIES")
 if cookies:
@@ -89,17 +99,23 @@ for k, v in extras.items():
 # print(l)
 print(len(l))
 
+manifest = DownloadManifest("moegirl/image/images/manifest.jsonl")
+
 bar = tqdm(l)
 for idx, i in enumerate(bar):
     url = i[0]
     name = i[1]
     fname = gen_cache_name(url)
     fname2 = "moegirl/image/images/{}".format(fname)
+    if manifest.done(fname2):
+        # bar.write("skip: " + fname)
+        continue
     if os.path.exists(fname2):
+        # downloaded before the manifest existed: check it once and record it
         if not validate_image(fname2, bar):
             bar.write("invalid " + fname)
             continue
-        # bar.write("skip: " + fname)
+        manifest.record(fname2, url, os.path.getsize(fname2))
         continue
     bar.set_description("{} {}".format(name, fname))
     try:
@@ -109,7 +125,10 @@ for idx, i in enumerate(bar):
                 fname2,
                 bar,
                 headers=headers,
+                verbose=False,
                 dynamic_cooldown=dynamic_cooldown,
+                rate_limiter=rate_limiter,
+                manifest=manifest,
             )
         else:
             res = safe_get(
@@ -119,7 +138,9 @@ for idx, i in enumerate(bar):
                 ),
                 bar=bar,
                 headers=headers,
+                verbose=False,
                 dynamic_cooldown=dynamic_cooldown,
+                rate_limiter=rate_limiter,
             )
             if res is None or res.status_code != 200:
                 bar.write(f"Failed to get URL for {url}")
@@ -141,10 +162,13 @@ for idx, i in enumerate(bar):
                 fname2,
                 bar,
                 headers=headers,
+                verbose=False,
                 dynamic_cooldown=dynamic_cooldown,
+                rate_limiter=rate_limiter,
+                manifest=manifest,
             )
     except Exception as e:
         # print(e)
         bar.write(str(e))
         # print(res)
-    bar.write("\n")
+    bar.set_postfix_str(default_metrics.summary(), refresh=False)
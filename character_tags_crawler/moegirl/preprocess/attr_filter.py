@@ -1,32 +1,29 @@
 from utils.file import load_json, save_json, chdir_project_root
+from moegirl.crawler.graph import load_graph
 
 chdir_project_root()
 
 attr_index: set[str] = set(load_json('moegirl/preprocess/attr_index.json'))
-data: dict = load_json('moegirl/crawler/attrs.json')
+graph = load_graph('moegirl/crawler/attrs.json')
 attr2char: dict[str, list[str]] = load_json('moegirl/preprocess/attr2char.json')
 hair_color_attr: list[str] = load_json('moegirl/preprocess/hair_color_attr.json')
 eye_color_attr: list[str] = load_json('moegirl/preprocess/eye_color_attr.json')
 
 
-def dfs(data: dict, ret: set[str]):
-    if 'name' in data:
-        name = data['name']
+def dfs(start: int, ret: set[str]):
+    for idx, _ in graph.walk(start):
+        name = graph.categories[idx].get('name')
         if name in attr_index:
             ret.add(name)
-    for i in data['subcategories']:
-        dfs(i, ret)
 
 
-for i in data['subcategories']:
-    if i['name'] == '按角色特征分类':
-        data = i
-        break
+data = graph.find('按角色特征分类')
 
 ret = set()
-for i in data['subcategories']:
+for i in graph.subcategories[data]:
     tmp: set[str] = set()
-    if i['name'] in [
+    name = graph.categories[i]['name']
+    if name in [
         '按外貌特征分类',
         '按体型特征分类',
         '按体质特征分类',
@@ -42,7 +39,7 @@ for i in data['subcategories']:
         dfs(i, tmp)
         tmp2 = list(filter(lambda x: len(attr2char[x]) >= 100, tmp))
         tmp2.sort(key=lambda x: len(attr2char[x]), reverse=True)
-        print(i['name'], tmp2)
+        print(name, tmp2)
         ret |= tmp
 
 ret |= set(
@@ -3,6 +3,7 @@ import random
 import urllib.parse
 
 from utils.file import save_json, chdir_project_root
+from moegirl.crawler.graph import load_graph
 
 chdir_project_root()
 
@@ -24,29 +25,15 @@ def attr_filter(attr_name: str) -> bool:
     return False
 
 
-dededupe: dict[str, dict] = {}
-
-
-def dfs(data: dict, stk: list, no_further: bool = False):
-    global dededupe
+def visit(data: dict, pages: list[dict], stk: list, no_further: bool = False):
+    # one category of the graph; stk and the returned no_further are what
+    # its subcategories are walked with
     global attr_index, attr_index_set
     global cv_index, cv_index_set
     global char_index, char_index_set
     global attr2article
     global char2attr
 
-    if (
-        len(data["subcategories"]) == 0
-        and len(data["pages"]) == 0
-        and data["url"] in dededupe
-    ):
-        # print(stk)
-        # print("dededupe:", data["url"], stk)
-        dfs(dededupe[data["url"]], stk, no_further)
-    if "url" in data and data["url"] not in dededupe:
-        # print("set", data["url"])
-        dededupe[data["url"]] = data
-
     if "name" in data and not no_further:
         attr_name = data["name"]
         if (
@@ -78,7 +65,7 @@ def dfs(data: dict, stk: list, no_further: bool = False):
             stk.append(attr_name)
         # if attr_name not in ['按角色特征分类', '按声优分类']:
     # print(stk)
-    for i in data["pages"]:
+    for i in pages:
         char_name = i["name"]
         if char_filter(char_name):
             continue
@@ -91,8 +78,7 @@ def dfs(data: dict, stk: list, no_further: bool = False):
         if char_name not in char2attr:
             char2attr[char_name] = []
         char2attr[char_name].append(stk[-1])
-    for i in data["subcategories"]:
-        dfs(i, stk.copy(), no_further)
+    return no_further
 
 
 attr2article: dict[str, str] = {}
@@ -103,10 +89,21 @@ char_index_set: set[str] = set()
 cv_index: list[str] = []
 cv_index_set: set[str] = set()
 
-data: dict = json.load(open("moegirl/crawler/attrs.json", encoding="utf-8"))
+graph = load_graph("moegirl/crawler/attrs.json")
 char2attr: dict[str, list[str]] = {}
 char2cv: dict[str, list[str]] = {}
-dfs(data, [])
+# each category is visited once, from the first parent that reaches it
+walked: dict[int, tuple[list, bool]] = {}
+for idx, parent in graph.walk():
+    stk, no_further = walked[parent] if parent is not None else ([], False)
+    stk = stk.copy()
+    no_further = visit(
+        graph.categories[idx],
+        [graph.pages[i] for i in graph.members[idx]],
+        stk,
+        no_further,
+    )
+    walked[idx] = (stk, no_further)
 attr_index.sort()
 char_index.sort()
 cv_index.sort()
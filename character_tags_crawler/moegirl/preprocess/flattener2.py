@@ -1,71 +1,85 @@
 from utils.file import load_json, save_json, chdir_project_root
 from utils.network import title_to_url
+from moegirl.crawler.graph import load_graph
 
 chdir_project_root()
 
 chars: set[str] = set(load_json('moegirl/preprocess/char_index.json'))
-subjects: dict = load_json('moegirl/crawler/subjects.json')
+subjects = load_graph('moegirl/crawler/subjects.json')
 attr_index: set[str] = set(load_json('moegirl/preprocess/attr_index.json'))
 
 
-def dfs(data: dict, ret: dict, stk: list = []):
+skipped = ['白眼', '轮回眼', '写轮眼', 'MS少女']
+
+
+def skip(idx: int) -> bool:
+    return subjects.categories[idx].get('name') in skipped
+
+
+# every category on some path from the root down to a category, the
+# category itself included; dicts as ordered sets. Parents are walked
+# before their children, so this settles after one pass unless the graph
+# has cycles
+order = [idx for idx, _ in subjects.walk(skip=skip)]
+ancestors: dict[int, dict[str, None]] = {idx: {} for idx in order}
+for idx in order:
+    data = subjects.categories[idx]
     if 'name' in data:
         rname = data['name']
         rurl = data['url']
-        # if '_' in rname:
-        #     print(rname, rurl)
         if '/Category:' + rname.replace(' ', '_') != rurl:
             print(data)
         assert '/Category:' + rname.replace(' ', '_') == rurl
-        if rname in ['白眼', '轮回眼', '写轮眼', 'MS少女']:
-            return
-        stk.append(rname)
-    if 'pages' in data:
-        for i in data['pages']:
-            name = i['name']
-            url = i['url']
-            # if '_' in name:
-            #     print(name, url)
-            if '/' + name.replace(' ', '_') != url:
-                print(i)
-            assert '/' + name.replace(' ', '_') == url
-            if name in chars:
-                if 'Bang Dream!' in stk:
-                    print(name, stk)
-                if name in ret:
-                    for j in stk:
-                        if j not in ret[name]:
-                            ret[name].append(j)
-                else:
-                    ret[name] = stk.copy()
-    if 'subcategories' in data:
-        for i in data['subcategories']:
-            dfs(i, ret, stk)
-    if 'name' in data:
-        stk.pop()
-
+        ancestors[idx][rname] = None
+changed = True
+while changed:
+    changed = False
+    for idx in order:
+        for child in subjects.subcategories[idx]:
+            if child not in ancestors:
+                continue
+            size = len(ancestors[child])
+            ancestors[child] = dict.fromkeys([*ancestors[idx], *ancestors[child]])
+            changed = changed or len(ancestors[child]) != size
 
 char2subject: dict[str, list[str]] = {}
-dfs(subjects, char2subject, [])
-# for k, v in ret.items():
-# print(k, v)
+for idx in order:
+    stk = list(ancestors[idx])
+    for i in subjects.members[idx]:
+        name = subjects.pages[i]['name']
+        url = subjects.pages[i]['url']
+        # if '_' in name:
+        #     print(name, url)
+        if '/' + name.replace(' ', '_') != url:
+            print(subjects.pages[i])
+        assert '/' + name.replace(' ', '_') == url
+        if name in chars:
+            if 'Bang Dream!' in stk:
+                print(name, stk)
+            if name in char2subject:
+                for j in stk:
+                    if j not in char2subject[name]:
+                        char2subject[name].append(j)
+            else:
+                char2subject[name] = stk.copy()
 print('all:', len(chars))
 print('found:', len(char2subject))
 save_json(char2subject, 'moegirl/preprocess/char2subject.json')
 
 subject_index: list[str] = []
-for i in subjects['subcategories']:
-    if i['name'] == "各地作品导航模板":
+categories = subjects.categories
+for i in subjects.subcategories[0]:
+    if categories[i]['name'] == "各地作品导航模板":
         pass
-    elif i['name'].startswith('各地区'):
-        for j in i['subcategories']:
-            for k in j['subcategories']:
-                name, url = k['name'], k['url']
+    elif categories[i]['name'].startswith('各地区'):
+        for j in subjects.subcategories[i]:
+            for k in subjects.subcategories[j]:
+                name, url = categories[k]['name'], categories[k]['url']
                 assert '/Category:' + name.replace(' ', '_') == url
                 subject_index.append(name)
     else:
-        for j in i['subcategories']:
-            name, url = j['name'], j['url']
+        for j in subjects.subcategories[i]:
+            name, url = categories[j]['name'], categories[j]['url']
             assert '/Category:' + name.replace(' ', '_') == url
             subject_index.append(name)
 
@@ -1,5 +1,6 @@
 from pypinyin import Style, lazy_pinyin
 from utils.file import save_json, load_json, chdir_project_root
+from moegirl.crawler.graph import load_graph
 
 chdir_project_root()
 
@@ -25,17 +26,8 @@ def gen(tags):
     return ret
 
 
-def dfs(d):
-    ret: set[str] = set()
-    if 'pages' in d:
-        for i in d['pages']:
-            v = i['name']
-            if v in chars:
-                ret.add(v)
-    if 'subcategories' in d:
-        for i in d['subcategories']:
-            ret |= dfs(i)
-    return ret
+def dfs(start):
+    return graph.page_names(start) & chars
 
 
 # d={}
@@ -51,10 +43,10 @@ def dfs(d):
 # for i in dd:
 #     print(i)
 
-attrs = load_json('moegirl/crawler/attrs.json')
+graph = load_graph('moegirl/crawler/attrs.json')
 vocaloid_root = None
-for i in attrs['subcategories']:
-    if i['name'] == '按歌声合成软件分类':
+for i in graph.subcategories[0]:
+    if graph.categories[i]['name'] == '按歌声合成软件分类':
         vocaloid_root = i
         break
 assert vocaloid_root is not None
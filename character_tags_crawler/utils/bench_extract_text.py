@@ -0,0 +1,80 @@
+# Times mwutils.extract_text on the infoboxes in extra_info.json:
+#
+#   git show <rev>:moegirl/crawler_extra/mwutils.py > /tmp/mwutils_old.py
+#   python utils/bench_extract_text.py --baseline /tmp/mwutils_old.py
+#
+# Every template node in the infobox parameter values goes through
+# extract_text once per run; --baseline runs the same nodes through another
+# copy of mwutils.py for comparison. Times are microseconds per node, best
+# of --repeat runs.
+import argparse
+import importlib.util
+import json
+import time
+import warnings
+
+import mwparserfromhell as mwp
+
+from moegirl.crawler_extra import mwutils
+from utils.file import chdir_project_root
+
+
+def load_module(path: str):
+    spec = importlib.util.spec_from_file_location('mwutils_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_nodes(path: str, limit: int | None) -> list:
+    extra = json.load(open(path, encoding='utf-8'))
+    nodes = []
+    for infoboxes in list(extra.values())[:limit]:
+        template = mwp.parse(infoboxes[0]).get(0)
+        for param in template.params:
+            nodes.extend(param.value.filter_templates())
+    return nodes
+
+
+def best_of(extract_text, nodes: list, repeat: int) -> float:
+    best = float('inf')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for node in nodes:
+                try:
+                    extract_text(node)
+                except Exception:
+                    pass
+            best = min(best, time.perf_counter() - start)
+    return best / len(nodes) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark mwutils.extract_text')
+    parser.add_argument('--extra', default='moegirl/crawler_extra/extra_info.json')
+    parser.add_argument('--baseline', help='another mwutils.py to compare with')
+    parser.add_argument('--limit', type=int, help='characters to take')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    nodes = load_nodes(args.extra, args.limit)
+    if not nodes:
+        print('no templates in', args.extra)
+        return
+    names = {str(node.name).strip().lower() for node in nodes}
+    print(f'{len(nodes)} template nodes, {len(names)} distinct names')
+    rows = []
+    if args.baseline:
+        baseline = load_module(args.baseline)
+        rows.append(('baseline', best_of(baseline.extract_text, nodes, args.repeat)))
+    rows.append(('mwutils', best_of(mwutils.extract_text, nodes, args.repeat)))
+    base = rows[0][1]
+    for label, us in rows:
+        print(f'  {label:10} {us:8.2f} us/node  x{base / us:.2f}')
+
+
+if __name__ == '__main__':
+    chdir_project_root()
+    main()
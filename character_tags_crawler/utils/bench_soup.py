@@ -0,0 +1,99 @@
+# Compares the HTML parser backends on pages recorded with CRAWLER_RECORD:
+#
+#   python utils/bench_soup.py bench.cassette --repeat 5
+#
+# Each page is parsed whole and restricted to the element the crawlers read
+# (parse_only), once per available parser; edit pages also go through the
+# regex textarea extraction. Times are milliseconds per page, best of
+# --repeat runs.
+import argparse
+import importlib.util
+import time
+
+from bs4 import SoupStrainer
+
+from utils.replay import Cassette
+from utils.soup import extract_textarea, make_soup
+
+# marker in the page -> element the crawlers need from it
+TARGETS = {
+    'mw-content-text': SoupStrainer('div', id='mw-content-text'),
+    'columnCrtBrowserB': SoupStrainer(id='columnCrtBrowserB'),
+    '<textarea': SoupStrainer('textarea'),
+}
+
+
+def available_parsers() -> list[str]:
+    ret = ['html.parser']
+    if importlib.util.find_spec('lxml') is not None:
+        ret.append('lxml')
+    return ret
+
+
+def load_pages(cassette: Cassette) -> dict[str, list[str]]:
+    pages: dict[str, list[str]] = {}
+    for url in cassette.urls():
+        hit = cassette.lookup(url)
+        if hit is None or hit[0] != 200:
+            continue
+        text = hit[2].decode('utf-8', errors='replace')
+        for marker in TARGETS:
+            if marker in text:
+                pages.setdefault(marker, []).append(text)
+                break
+    return pages
+
+
+def best_of(fn, pages: list[str], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            fn(page)
+        best = min(best, time.perf_counter() - start)
+    return best / len(pages) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark HTML parser backends')
+    parser.add_argument('cassette')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_pages(Cassette(args.cassette))
+    if not pages:
+        print('no recorded HTML pages in', args.cassette)
+        return
+    for marker, texts in pages.items():
+        strainer = TARGETS[marker]
+        kb = sum(map(len, texts)) / len(texts) / 1024
+        print(f'{marker}: {len(texts)} pages, {kb:.0f}KB on average')
+        rows = []
+        for name in available_parsers():
+            rows.append(
+                (
+                    f'{name} full',
+                    best_of(lambda t: make_soup(t, parser=name), texts, args.repeat),
+                )
+            )
+            rows.append(
+                (
+                    f'{name} parse_only',
+                    best_of(
+                        lambda t: make_soup(t, parse_only=strainer, parser=name),
+                        texts,
+                        args.repeat,
+                    ),
+                )
+            )
+        if marker == '<textarea':
+            rows.append(
+                ('regex textarea', best_of(extract_textarea, texts, args.repeat))
+            )
+        base = rows[0][1]
+        for label, ms in rows:
+            print(f'  {label:24} {ms:8.3f} ms/page  x{base / ms:.1f}')
+
+
+if __name__ == '__main__':
+    main()
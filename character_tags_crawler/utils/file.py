@@ -1,5 +1,8 @@
 import json
 import os
+import time
+from threading import Event, Lock, Thread
+from typing import Callable
 
 
 def chdir_project_root():
@@ -35,6 +38,80 @@ def save_json_pretty(data: object, path: str, verbose: bool = True):
     )
 
 
+def write_atomic(path: str, data: str | bytes):
+    # write next to the target and rename, so readers never see a partial file
+    tmp = path + '.tmp'
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    encoding = None if isinstance(data, bytes) else 'utf-8'
+    with open(tmp, mode, encoding=encoding) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Checkpointer:
+    # Writes snapshot() to path with write_atomic from a background thread,
+    # every `interval` seconds or as soon as progress() has grown by `every`.
+    # snapshot should hold the lock guarding the data only while serializing
+    # it; the slow part, writing and syncing the file, runs without it.
+    def __init__(
+        self,
+        path: str,
+        snapshot: Callable[[], str | bytes],
+        interval: float = 300,
+        progress: Callable[[], int] | None = None,
+        every: int | None = None,
+        verbose: bool = True,
+    ):
+        self.path = path
+        self.snapshot = snapshot
+        self.interval = interval
+        self.progress = progress
+        self.every = every
+        self.verbose = verbose
+        self.saved = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def save(self):
+        data = self.snapshot()
+        with self.lock:
+            write_atomic(self.path, data)
+            self.saved += 1
+
+    def run(self):
+        last_time = time.monotonic()
+        last_progress = self.progress() if self.progress else 0
+        while not self.stopped.wait(1):
+            progress = self.progress() if self.progress else 0
+            if time.monotonic() - last_time >= self.interval or (
+                self.every and progress - last_progress >= self.every
+            ):
+                try:
+                    self.save()
+                    if self.verbose:
+                        print(f'checkpoint saved to {self.path}')
+                except Exception as e:
+                    # keep crawling, the next checkpoint may succeed
+                    print(f'checkpoint to {self.path} failed: {e}')
+                last_time = time.monotonic()
+                last_progress = progress
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, save: bool = True):
+        # stops the thread and, with save, writes the final state
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if save:
+            self.save()
+
+
 def load_json(path: str):
     return json.load(open(path, encoding='utf8'))
 
@@ -43,3 +120,53 @@ def load_json_or_none(path: str):
     if not os.path.exists(path):
         return None
     return json.load(open(path, encoding='utf8'))
+
+
+class DownloadManifest:
+    # Append-only JSON lines of finished downloads. A path listed here was
+    # verified when it was written and is never downloaded or checked again;
+    # one recorded with verified=False (nothing to check it against) is
+    # listed but not done.
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, dict] = {}
+        self.lock = Lock()
+        if os.path.exists(path):
+            with open(path, 'rb+') as f:
+                end = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # torn last line from a killed run, cut off so the
+                        # next record starts on a line of its own
+                        break
+                    end += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['path']] = entry
+                f.truncate(end)
+
+    def done(self, path: str) -> bool:
+        entry = self.entries.get(path)
+        return (
+            entry is not None and entry.get('verified', True) and os.path.exists(path)
+        )
+
+    def record(
+        self,
+        path: str,
+        url: str,
+        size: int,
+        sha256: str | None = None,
+        verified: bool = True,
+    ):
+        entry = {'path': path, 'url': url, 'size': size}
+        if sha256:
+            entry['sha256'] = sha256
+        if not verified:
+            entry['verified'] = False
+        with self.lock:
+            self.entries[path] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
@@ -0,0 +1,305 @@
+# Durable work queue shared by the crawlers, one sqlite file per crawl.
+# Several processes may lease from the same file; a lease that is not
+# finished within lease_seconds (crashed or killed worker) goes back to
+# pending, or to failed once the item has used up max_attempts. Only the
+# current holder of a lease can settle an item leased through this
+# Frontier. `python utils/frontier.py <db>` prints what is left.
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+from threading import Lock
+from typing import Any, Iterable, Iterator
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def default_worker_id() -> str:
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Frontier:
+    def __init__(
+        self,
+        path: str,
+        queue: str = 'default',
+        lease_seconds: float = 600,
+        max_attempts: int = 5,
+    ):
+        self.path = path
+        self.queue = queue
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # autocommit mode, writes that must be atomic use BEGIN IMMEDIATE
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'queue TEXT, key TEXT, payload TEXT, state TEXT, priority INTEGER, '
+            'attempts INTEGER, owner TEXT, lease_until REAL, error TEXT, '
+            'updated REAL, PRIMARY KEY (queue, key))'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS items_ready '
+            'ON items (queue, state, priority DESC)'
+        )
+        self.lock = Lock()
+        # key -> worker of the items leased through this instance
+        self.owners: dict[str, str] = {}
+
+    def add(
+        self,
+        keys: Iterable[str | tuple[str, Any]],
+        priority: int = 0,
+        state: str = PENDING,
+    ) -> int:
+        # keys may be plain keys or (key, payload); existing keys are kept as is
+        items = []
+        for i in keys:
+            key, payload = i if isinstance(i, tuple) else (i, None)
+            items.append((key, payload, state))
+        return self.insert(items, priority)
+
+    def seed(self, items: Iterable[tuple[str, Any, str]], priority: int = 0) -> int:
+        # adds (key, payload, state) items only if the queue is empty, in one
+        # transaction: of several workers starting together exactly one seeds
+        # the queue, and none of them sees it half seeded
+        return self.insert(items, priority, if_empty=True)
+
+    def insert(
+        self,
+        items: Iterable[tuple[str, Any, str]],
+        priority: int = 0,
+        if_empty: bool = False,
+    ) -> int:
+        now = time.time()
+        rows = [
+            (
+                self.queue,
+                str(key),
+                json.dumps(payload, ensure_ascii=False),
+                state,
+                priority,
+                now,
+            )
+            for key, payload, state in items
+        ]
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            if if_empty:
+                found = self.db.execute(
+                    'SELECT 1 FROM items WHERE queue = ? LIMIT 1', (self.queue,)
+                ).fetchone()
+                if found:
+                    self.db.execute('ROLLBACK')
+                    return 0
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO items '
+                '(queue, key, payload, state, priority, attempts, updated) '
+                'VALUES (?, ?, ?, ?, ?, 0, ?)',
+                rows,
+            )
+            added = self.db.total_changes - before
+            self.db.execute('COMMIT')
+        return added
+
+    def lease(
+        self, worker: str, n: int = 1, lease_seconds: float | None = None
+    ) -> list[tuple[str, Any]]:
+        now = time.time()
+        until = now + (lease_seconds or self.lease_seconds)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                # items that keep killing their workers are given up on
+                self.db.execute(
+                    'UPDATE items SET '
+                    'state = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                    "error = CASE WHEN attempts >= ? THEN 'lease expired' ELSE error END, "
+                    'owner = NULL, updated = ? '
+                    'WHERE queue = ? AND state = ? AND lease_until < ?',
+                    (
+                        self.max_attempts,
+                        FAILED,
+                        PENDING,
+                        self.max_attempts,
+                        now,
+                        self.queue,
+                        IN_FLIGHT,
+                        now,
+                    ),
+                )
+                rows = self.db.execute(
+                    'SELECT key, payload FROM items WHERE queue = ? AND state = ? '
+                    'ORDER BY priority DESC, rowid LIMIT ?',
+                    (self.queue, PENDING, n),
+                ).fetchall()
+                self.db.executemany(
+                    'UPDATE items SET state = ?, owner = ?, lease_until = ?, '
+                    'attempts = attempts + 1, updated = ? WHERE queue = ? AND key = ?',
+                    [(IN_FLIGHT, worker, until, now, self.queue, k) for k, _ in rows],
+                )
+                self.db.execute('COMMIT')
+                self.owners.update((k, worker) for k, _ in rows)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return [(k, json.loads(p)) for k, p in rows]
+
+    def iter_leases(
+        self,
+        worker: str,
+        n: int = 1,
+        lease_seconds: float | None = None,
+        poll: float | None = None,
+    ) -> Iterator[list[tuple[str, Any]]]:
+        # leases batches until nothing is pending; whatever is still leased
+        # when the loop is left early goes back to pending. With `poll` set,
+        # waits while other workers hold leases, as they may add new items
+        try:
+            while True:
+                batch = self.lease(worker, n, lease_seconds)
+                if batch:
+                    yield batch
+                elif poll is not None and self.remaining() > 0:
+                    time.sleep(poll)
+                else:
+                    return
+        finally:
+            self.release(worker)
+
+    def owned(self, key: str) -> tuple[str, tuple]:
+        # extra WHERE clause and parameters so that an item leased through
+        # this instance is only updated while the lease is still ours
+        owner = self.owners.pop(str(key), None)
+        if owner is None:
+            return '', ()
+        return ' AND state = ? AND owner = ?', (IN_FLIGHT, owner)
+
+    def settled(self, key: str, updated: int) -> bool:
+        if not updated:
+            print(
+                f'frontier: lease on {key} expired and was taken over, '
+                'result not recorded',
+                file=sys.stderr,
+            )
+        return bool(updated)
+
+    def done(self, key: str) -> bool:
+        return self.set_state(key, DONE)
+
+    def fail(self, key: str, error: str = '', retry: bool = True) -> bool:
+        with self.lock:
+            where, params = self.owned(key)
+            updated = self.db.execute(
+                'UPDATE items SET state = CASE WHEN ? AND attempts < ? THEN ? ELSE ? END, '
+                'owner = NULL, error = ?, updated = ? WHERE queue = ? AND key = ?'
+                + where,
+                (
+                    retry,
+                    self.max_attempts,
+                    PENDING,
+                    FAILED,
+                    error,
+                    time.time(),
+                    self.queue,
+                    str(key),
+                    *params,
+                ),
+            ).rowcount
+        return self.settled(key, updated)
+
+    def set_state(self, key: str, state: str) -> bool:
+        # False when the lease on key was lost to another worker
+        with self.lock:
+            where, params = self.owned(key)
+            updated = self.db.execute(
+                'UPDATE items SET state = ?, owner = NULL, updated = ? '
+                'WHERE queue = ? AND key = ?' + where,
+                (state, time.time(), self.queue, str(key), *params),
+            ).rowcount
+        return self.settled(key, updated)
+
+    def release(self, worker: str):
+        with self.lock:
+            for key in [k for k, w in self.owners.items() if w == worker]:
+                del self.owners[key]
+            self.db.execute(
+                'UPDATE items SET state = ?, owner = NULL, attempts = attempts - 1 '
+                'WHERE queue = ? AND state = ? AND owner = ?',
+                (PENDING, self.queue, IN_FLIGHT, worker),
+            )
+
+    def requeue(self, keys: Iterable[str], payload: Any = None) -> int:
+        # back to pending with fresh attempts, e.g. done items to fetch again;
+        # a payload given replaces the stored one, so it survives a restart
+        payload = None if payload is None else json.dumps(payload, ensure_ascii=False)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            before = self.db.total_changes
+            self.db.executemany(
+                'UPDATE items SET state = ?, owner = NULL, attempts = 0, '
+                'error = NULL, payload = COALESCE(?, payload), updated = ? '
+                'WHERE queue = ? AND key = ?',
+                [(PENDING, payload, time.time(), self.queue, str(k)) for k in keys],
+            )
+            changed = self.db.total_changes - before
+            self.db.execute('COMMIT')
+        return changed
+
+    def retry_failed(self) -> int:
+        with self.lock:
+            return self.db.execute(
+                'UPDATE items SET state = ?, attempts = 0 WHERE queue = ? AND state = ?',
+                (PENDING, self.queue, FAILED),
+            ).rowcount
+
+    def keys(self, state: str) -> list[str]:
+        with self.lock:
+            return [
+                i[0]
+                for i in self.db.execute(
+                    'SELECT key FROM items WHERE queue = ? AND state = ?',
+                    (self.queue, state),
+                )
+            ]
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(
+                self.db.execute(
+                    'SELECT state, COUNT(*) FROM items WHERE queue = ? GROUP BY state',
+                    (self.queue,),
+                ).fetchall()
+            )
+
+    def remaining(self) -> int:
+        stats = self.stats()
+        return stats.get(PENDING, 0) + stats.get(IN_FLIGHT, 0)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+if __name__ == '__main__':
+    db = sqlite3.connect(sys.argv[1])
+    for queue, state, count in db.execute(
+        'SELECT queue, state, COUNT(*) FROM items GROUP BY queue, state'
+    ):
+        print(f'{queue:20} {state:10} {count}')
+    for queue, key, error in db.execute(
+        'SELECT queue, key, error FROM items WHERE state = ? LIMIT 20', (FAILED,)
+    ):
+        print(f'failed: {queue} {key}: {error}')
@@ -0,0 +1,253 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# headers that describe the cached body itself rather than the response
+DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+# request headers that must not take part in the cache key
+UNKEYED_HEADERS = {'if-none-match', 'if-modified-since'}
+
+
+class HttpCache:
+    # Response cache in one sqlite file, keyed by url + request headers.
+    # Entries younger than `fresh_for` are served without a request, older
+    # ones are revalidated with If-None-Match / If-Modified-Since. Entries not
+    # validated for `ttl` seconds are dropped, and the least recently used
+    # ones go first once the bodies exceed `max_bytes`.
+    def __init__(
+        self,
+        path: str,
+        fresh_for: float = 0,
+        ttl: float | None = None,
+        max_bytes: int | None = None,
+    ):
+        self.path = path
+        self.fresh_for = fresh_for
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT, '
+            'body BLOB, etag TEXT, last_modified TEXT, '
+            'validated REAL, accessed REAL, size INTEGER)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_validated ON responses (validated)'
+        )
+        self.db.commit()
+        self.lock = Lock()
+        self.total_bytes = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
+        self.evict()
+
+    @classmethod
+    def from_env(cls) -> 'HttpCache | None':
+        # HTTP_CACHE=<path> turns the cache on for a crawler script
+        path = os.getenv('HTTP_CACHE')
+        if not path:
+            return None
+        ttl = os.getenv('HTTP_CACHE_TTL')
+        max_mb = os.getenv('HTTP_CACHE_MAX_MB')
+        return cls(
+            path,
+            fresh_for=float(os.getenv('HTTP_CACHE_FRESH', '0')),
+            ttl=float(ttl) if ttl else None,
+            max_bytes=int(float(max_mb) * 1024 * 1024) if max_mb else None,
+        )
+
+    @staticmethod
+    def key(url: str, headers: dict) -> str:
+        items = sorted(
+            (k.lower(), str(v))
+            for k, v in headers.items()
+            if k.lower() not in UNKEYED_HEADERS
+        )
+        return hashlib.sha1(
+            json.dumps([url, items], ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+
+    def lookup(self, url: str, headers: dict) -> dict | None:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT key, url, status, headers, body, etag, last_modified, '
+                'validated FROM responses WHERE key = ?',
+                (self.key(url, headers),),
+            ).fetchone()
+        if row is None:
+            return None
+        entry = dict(
+            zip(
+                (
+                    'key',
+                    'url',
+                    'status',
+                    'headers',
+                    'body',
+                    'etag',
+                    'last_modified',
+                    'validated',
+                ),
+                row,
+            )
+        )
+        if self.ttl is not None and time.time() - entry['validated'] > self.ttl:
+            return None
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        return time.time() - entry['validated'] < self.fresh_for
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        ret = {}
+        if entry['etag']:
+            ret['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            ret['If-Modified-Since'] = entry['last_modified']
+        return ret
+
+    def hit(self, entry: dict) -> requests.Response:
+        with self.lock:
+            self.hits += 1
+            self.db.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                (time.time(), entry['key']),
+            )
+            self.db.commit()
+        return self.to_response(entry)
+
+    def update(
+        self,
+        url: str,
+        headers: dict,
+        response: requests.Response,
+        entry: dict | None,
+    ) -> requests.Response:
+        # called with the network response to a (possibly conditional) request;
+        # returns what the caller should see
+        now = time.time()
+        if response.status_code == 304 and entry is not None:
+            etag = response.headers.get('ETag') or entry['etag']
+            last_modified = (
+                response.headers.get('Last-Modified') or entry['last_modified']
+            )
+            with self.lock:
+                self.revalidated += 1
+                self.db.execute(
+                    'UPDATE responses SET etag = ?, last_modified = ?, '
+                    'validated = ?, accessed = ? WHERE key = ?',
+                    (etag, last_modified, now, now, entry['key']),
+                )
+                self.db.commit()
+            ret = self.to_response(entry)
+            ret.elapsed = response.elapsed
+            return ret
+        with self.lock:
+            self.misses += 1
+        if response.status_code != 200:
+            return response
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        body = response.content
+        stored_headers = {
+            k: v for k, v in response.headers.items() if k.lower() not in DROPPED_HEADERS
+        }
+        key = self.key(url, headers)
+        with self.lock:
+            old = self.db.execute(
+                'SELECT size FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    key,
+                    url,
+                    response.status_code,
+                    json.dumps(stored_headers),
+                    body,
+                    etag,
+                    last_modified,
+                    now,
+                    now,
+                    len(body),
+                ),
+            )
+            self.db.commit()
+            self.total_bytes += len(body)
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+        return response
+
+    def evict(self):
+        with self.lock:
+            if self.ttl is not None:
+                self.db.execute(
+                    'DELETE FROM responses WHERE validated < ?',
+                    (time.time() - self.ttl,),
+                )
+            if self.max_bytes is not None:
+                # drop least recently used entries down to 90% of the budget
+                target = self.max_bytes * 0.9
+                total = self.db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM responses'
+                ).fetchone()[0]
+                if total > target:
+                    cutoff = None
+                    for accessed, size in self.db.execute(
+                        'SELECT accessed, size FROM responses ORDER BY accessed'
+                    ):
+                        total -= size
+                        cutoff = accessed
+                        if total <= target:
+                            break
+                    self.db.execute(
+                        'DELETE FROM responses WHERE accessed <= ?', (cutoff,)
+                    )
+            self.db.commit()
+            self.total_bytes = self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()[0]
+
+    @staticmethod
+    def to_response(entry: dict) -> requests.Response:
+        r = requests.Response()
+        r.status_code = entry['status']
+        r._content = entry['body']
+        r.headers = CaseInsensitiveDict(json.loads(entry['headers']))
+        r.url = entry['url']
+        r.elapsed = datetime.timedelta(0)
+        r.request = requests.Request('GET', entry['url']).prepare()
+        r.from_cache = True  # type: ignore
+        return r
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,137 @@
+# Results of a parser stored in sqlite by the hash of its input text, so a
+# rerun only parses the texts it has not seen. Entries belong to a parser
+# name and version; opening the memo with another version drops that
+# parser's entries, so bump the version whenever the parser's output
+# changes. Values are stored as json.
+import hashlib
+import json
+import os
+import sqlite3
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator
+
+from utils.parallel import process_map
+
+# texts looked up per query and results stored per transaction
+BATCH = 500
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    # for versions of parsers that read a data file besides their input
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+class Memo:
+    def __init__(self, path: str, name: str, version: int | str):
+        self.name = name
+        self.version = str(version)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS memo ('
+            'name TEXT, hash TEXT, version TEXT, value TEXT, '
+            'PRIMARY KEY (name, hash))'
+        )
+        with self.db:
+            dropped = self.db.execute(
+                'DELETE FROM memo WHERE name = ? AND version != ?',
+                (self.name, self.version),
+            ).rowcount
+        if dropped:
+            print(f'dropped {dropped} {name} results of older parser versions')
+
+    def lookup(self, hashes: Iterable[str]) -> dict[str, Any]:
+        hashes = list(hashes)
+        ret = {}
+        for i in range(0, len(hashes), BATCH):
+            chunk = hashes[i : i + BATCH]
+            rows = self.db.execute(
+                'SELECT hash, value FROM memo WHERE name = ? AND hash IN (%s)'
+                % ','.join('?' * len(chunk)),
+                (self.name, *chunk),
+            )
+            ret.update((h, json.loads(value)) for h, value in rows)
+        return ret
+
+    def store(self, results: dict[str, Any]):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)',
+                (
+                    (self.name, h, self.version, json.dumps(value, ensure_ascii=False))
+                    for h, value in results.items()
+                ),
+            )
+
+    def map(
+        self, fn: Callable[[str], Any], keys: Iterable, load: Callable[[Any], str]
+    ) -> Iterator[tuple[Any, Any, str | None]]:
+        # (key, fn(load(key)), None) or (key, None, traceback) for each key,
+        # in order. Each text is loaded once: texts without a stored result
+        # are handed to process_map as they are read, the rest answered from
+        # the memo
+        done = {}
+        errors = {}
+        parsing = set()
+        # (key, hash, whether this key's text was sent to be parsed)
+        plan = deque()
+
+        def scan():
+            it = iter(keys)
+            while chunk := list(islice(it, BATCH)):
+                texts = [load(key) for key in chunk]
+                hashes = [digest(text) for text in texts]
+                done.update(self.lookup(set(hashes) - done.keys() - parsing))
+                for key, text, h in zip(chunk, texts, hashes):
+                    first = h not in done and h not in parsing
+                    plan.append((key, h, first))
+                    if first:
+                        parsing.add(h)
+                        yield text
+
+        results = process_map(fn, scan())
+        # results read ahead while looking for the next plan entry
+        ahead = deque()
+        fresh = {}
+        total = 0
+        try:
+            while True:
+                if not plan:
+                    # reading a result makes process_map scan further
+                    try:
+                        ahead.append(next(results))
+                    except StopIteration:
+                        if not plan:
+                            break
+                    continue
+                key, h, first = plan.popleft()
+                total += 1
+                if first:
+                    result, error = ahead.popleft() if ahead else next(results)
+                    if error:
+                        errors[h] = error
+                    else:
+                        done[h] = fresh[h] = result
+                        if len(fresh) >= BATCH:
+                            self.store(fresh)
+                            fresh = {}
+                if h in errors:
+                    yield key, None, errors[h]
+                else:
+                    yield key, done[h], None
+        finally:
+            # also keeps the work of a run stopped early
+            self.store(fresh)
+            results.close()
+        print(f'{self.name}: parsed {len(parsing)} of {total} texts')
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,237 @@
+import atexit
+import json
+import math
+import os
+import time
+import urllib.parse
+from threading import Event, Lock, Thread
+
+from utils.file import write_atomic
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+
+class HostMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.bytes = 0
+        self.status: dict[int, int] = {}
+        self.retries = 0
+        self.errors = 0
+        self.cooldown = 0.0
+        self.cache_hits = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'latency_buckets': {
+                str(le): n for le, n in zip(LATENCY_BUCKETS, self.latency_buckets)
+            },
+            'latency_sum': round(self.latency_sum, 3),
+            'bytes': self.bytes,
+            'status': {str(k): v for k, v in sorted(self.status.items())},
+            'retries': self.retries,
+            'errors': self.errors,
+            'cooldown': round(self.cooldown, 3),
+            'cache_hits': self.cache_hits,
+        }
+
+
+class Metrics:
+    # Per-host request counters, filled in by the network engine. summary()
+    # is meant for a progress bar postfix, dump() for files scraped by other
+    # tools (.prom for Prometheus text format, anything else for JSON).
+    def __init__(self):
+        self.hosts: dict[str, HostMetrics] = {}
+        self.started = time.time()
+        self.lock = Lock()
+        self.stop_event: Event | None = None
+        self.dumper: Thread | None = None
+
+    def host(self, url: str) -> HostMetrics:
+        host = urllib.parse.urlsplit(url).netloc or url
+        if host not in self.hosts:
+            self.hosts[host] = HostMetrics()
+        return self.hosts[host]
+
+    def observe(
+        self,
+        url: str,
+        status: int,
+        latency: float,
+        nbytes: int = 0,
+        retries: int = 0,
+        cooldown: float = 0.0,
+        cached: bool = False,
+    ):
+        with self.lock:
+            h = self.host(url)
+            h.requests += 1
+            for i, le in enumerate(LATENCY_BUCKETS):
+                if latency <= le:
+                    h.latency_buckets[i] += 1
+                    break
+            h.latency_sum += latency
+            h.bytes += nbytes
+            h.status[status] = h.status.get(status, 0) + 1
+            h.retries += retries
+            h.cooldown += cooldown
+            if cached:
+                h.cache_hits += 1
+
+    def error(self, url: str):
+        with self.lock:
+            self.host(url).errors += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'started': self.started,
+                'time': time.time(),
+                'hosts': {k: v.to_dict() for k, v in self.hosts.items()},
+            }
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th latency over all hosts
+        with self.lock:
+            counts = [0] * len(LATENCY_BUCKETS)
+            for h in self.hosts.values():
+                for i, n in enumerate(h.latency_buckets):
+                    counts[i] += n
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        seen = 0
+        for le, n in zip(LATENCY_BUCKETS, counts):
+            seen += n
+            if seen >= q * total:
+                return le
+        return math.inf
+
+    def summary(self) -> str:
+        with self.lock:
+            requests = sum(h.requests for h in self.hosts.values())
+            nbytes = sum(h.bytes for h in self.hosts.values())
+            errors = sum(h.errors for h in self.hosts.values())
+            retries = sum(h.retries for h in self.hosts.values())
+            cache_hits = sum(h.cache_hits for h in self.hosts.values())
+            classes: dict[str, int] = {}
+            for h in self.hosts.values():
+                for status, n in h.status.items():
+                    k = '{}xx'.format(status // 100)
+                    classes[k] = classes.get(k, 0) + n
+        elapsed = max(time.time() - self.started, 1e-9)
+        ret = '{} req {:.1f}/s {:.1f}MB'.format(
+            requests, requests / elapsed, nbytes / 1024 / 1024
+        )
+        for k in sorted(classes):
+            ret += ' {}={}'.format(k, classes[k])
+        if cache_hits:
+            ret += ' cached={}'.format(cache_hits)
+        if retries:
+            ret += ' retries={}'.format(retries)
+        if errors:
+            ret += ' err={}'.format(errors)
+        ret += ' p50<={}s p95<={}s'.format(self.quantile(0.5), self.quantile(0.95))
+        return ret
+
+    def to_prometheus(self) -> str:
+        snap = self.snapshot()
+        lines = []
+
+        def family(name, kind, rows):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(rows)
+
+        hosts = snap['hosts']
+        family(
+            'crawler_requests_total',
+            'counter',
+            [
+                'crawler_requests_total{{host="{}",status="{}"}} {}'.format(
+                    host, status, n
+                )
+                for host, h in hosts.items()
+                for status, n in h['status'].items()
+            ],
+        )
+        rows = []
+        for host, h in hosts.items():
+            acc = 0
+            for le, n in h['latency_buckets'].items():
+                acc += n
+                le = '+Inf' if le == 'inf' else le
+                rows.append(
+                    'crawler_request_seconds_bucket{{host="{}",le="{}"}} {}'.format(
+                        host, le, acc
+                    )
+                )
+            rows.append(
+                'crawler_request_seconds_sum{{host="{}"}} {}'.format(
+                    host, h['latency_sum']
+                )
+            )
+            rows.append(
+                'crawler_request_seconds_count{{host="{}"}} {}'.format(
+                    host, h['requests']
+                )
+            )
+        family('crawler_request_seconds', 'histogram', rows)
+        for key, name in (
+            ('bytes', 'crawler_bytes_total'),
+            ('retries', 'crawler_retries_total'),
+            ('errors', 'crawler_errors_total'),
+            ('cooldown', 'crawler_cooldown_seconds_total'),
+            ('cache_hits', 'crawler_cache_hits_total'),
+        ):
+            family(
+                name,
+                'counter',
+                [
+                    '{}{{host="{}"}} {}'.format(name, host, h[key])
+                    for host, h in hosts.items()
+                ],
+            )
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        if path.endswith('.prom'):
+            write_atomic(path, self.to_prometheus())
+        else:
+            write_atomic(path, json.dumps(self.snapshot(), indent=2))
+
+    def start_dumper(self, path: str, interval: float = 30):
+        # the thread is a daemon; the exit hook stops it and waits for the
+        # final dump, so the last interval is not lost
+        self.stop_dumper()
+        self.stop_event = Event()
+        stop_event = self.stop_event
+
+        def run():
+            while not stop_event.wait(interval):
+                self.dump(path)
+            self.dump(path)
+
+        self.dumper = Thread(target=run, name='metrics-dumper', daemon=True)
+        self.dumper.start()
+        atexit.register(self.stop_dumper)
+
+    def stop_dumper(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+            self.stop_event = None
+        if self.dumper is not None:
+            self.dumper.join()
+            self.dumper = None
+
+
+default_metrics = Metrics()
+
+
+def dump_metrics_from_env(metrics: Metrics = default_metrics):
+    # CRAWLER_METRICS=<path.json|path.prom> dumps every CRAWLER_METRICS_INTERVAL s
+    path = os.getenv('CRAWLER_METRICS')
+    if path:
+        metrics.start_dumper(path, float(os.getenv('CRAWLER_METRICS_INTERVAL', '30')))
@@ -1,20 +1,43 @@
+import asyncio
+import email.utils
+import hashlib
+import os
 import shutil
+import sqlite3
 import time
 import random
 from tqdm import tqdm
 import requests
 import urllib.parse
-from bs4 import BeautifulSoup
+from collections import OrderedDict, deque
+from bs4 import BeautifulSoup, SoupStrainer
+import urllib3
 from urllib3 import Retry
 from requests.adapters import HTTPAdapter
-from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from threading import Condition, Lock, Thread
+from typing import Iterable, Iterator
+
+from utils.file import DownloadManifest
+from utils.http_cache import HttpCache
+from utils.metrics import Metrics, default_metrics
+from utils.replay import Cassette, to_replay
+from utils.soup import make_soup
 
 requests.adapters.DEFAULT_RETRIES = 3  # type: ignore
 
+# sized for AsyncEngine.max_per_host so concurrent requests reuse connections
+POOL_MAXSIZE = 256
+
 global_session = requests.Session()
 retry = Retry(total=10, backoff_factor=3, backoff_max=10)
-global_session.mount('https', HTTPAdapter(max_retries=retry))
-global_session.mount('http', HTTPAdapter(max_retries=retry))
+global_session.mount(
+    'https', HTTPAdapter(max_retries=retry, pool_maxsize=POOL_MAXSIZE)
+)
+global_session.mount(
+    'http', HTTPAdapter(max_retries=retry, pool_maxsize=POOL_MAXSIZE)
+)
 
 
 class DynamicCooldown:
@@ -31,60 +54,728 @@ class DynamicCooldown:
         self.jitter = jitter
         self.slow_response_count = 0
         self.fast_response_count = 0
+        self.lock = Lock()
 
     def get(self):
         jittered = self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
         return max(self.min_cooldown, min(self.max_cooldown, jittered))
 
     def update(self, response_time):
-        if response_time > self.slow_threshold:
-            self.slow_response_count += 1
-            self.fast_response_count = 0
-            if self.slow_response_count >= 2:
-                self.current = min(self.max_cooldown, self.current * self.increase_factor)
+        with self.lock:
+            if response_time > self.slow_threshold:
+                self.slow_response_count += 1
+                self.fast_response_count = 0
+                if self.slow_response_count >= 2:
+                    self.current = min(
+                        self.max_cooldown, self.current * self.increase_factor
+                    )
+                    self.slow_response_count = 0
+            elif response_time < self.fast_threshold:
+                self.fast_response_count += 1
+                self.slow_response_count = 0
+                if self.fast_response_count >= 5:
+                    self.current = max(
+                        self.min_cooldown, self.current * self.decrease_factor
+                    )
+                    self.fast_response_count = 0
+            else:
                 self.slow_response_count = 0
-        elif response_time < self.fast_threshold:
-            self.fast_response_count += 1
-            self.slow_response_count = 0
-            if self.fast_response_count >= 5:
-                self.current = max(self.min_cooldown, self.current * self.decrease_factor)
                 self.fast_response_count = 0
-        else:
-            self.slow_response_count = 0
-            self.fast_response_count = 0
 
     def reset(self):
-        self.current = self.min_cooldown
-        self.slow_response_count = 0
-        self.fast_response_count = 0
+        with self.lock:
+            self.current = self.min_cooldown
+            self.slow_response_count = 0
+            self.fast_response_count = 0
 
 
 default_dynamic_cooldown = DynamicCooldown()
 
 
+class ConcurrencyController:
+    # AIMD window on the number of requests in flight. Fast responses grow
+    # the window by `increase` per window's worth of responses, slow ones or
+    # 429/5xx cut it by `decrease_factor`, at most once per `cut_interval`
+    # seconds so one congested burst only counts once.
+    def __init__(
+        self,
+        initial: float = 4,
+        min_window: float = 1,
+        max_window: float = 64,
+        slow_threshold: float = 1.0,
+        fast_threshold: float = 0.3,
+        increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        cut_interval: float = 1.0,
+        history: int = 100,
+    ):
+        self.window = float(initial)
+        self.min_window = min_window
+        self.max_window = max_window
+        self.slow_threshold = slow_threshold
+        self.fast_threshold = fast_threshold
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.cut_interval = cut_interval
+        self.in_flight = 0
+        self.last_cut = 0.0
+        self.decisions: deque[dict] = deque(maxlen=history)
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        self.waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def limit(self) -> int:
+        return max(1, int(self.window))
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.in_flight < self.limit():
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit():
+                self.cond.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.in_flight < self.limit():
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self):
+        # caller holds self.lock
+        self.cond.notify_all()
+        waiters, self.waiters = self.waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_resolve, waiter)
+
+    def update(self, latency: float, status: int = 200):
+        with self.lock:
+            before = self.limit()
+            if status == 429 or status == 0 or status >= 500:
+                action = 'cut-error'
+            elif latency > self.slow_threshold:
+                action = 'cut-slow'
+            elif latency < self.fast_threshold:
+                action = 'grow'
+            else:
+                return
+            now = time.monotonic()
+            if action == 'grow':
+                self.window = min(
+                    self.max_window, self.window + self.increase / self.window
+                )
+            elif now - self.last_cut >= self.cut_interval:
+                self.last_cut = now
+                self.window = max(
+                    self.min_window, self.window * self.decrease_factor
+                )
+            else:
+                return
+            if self.limit() != before:
+                self.decisions.append(
+                    {
+                        'time': time.time(),
+                        'action': action,
+                        'latency': round(latency, 3),
+                        'status': status,
+                        'window': self.limit(),
+                    }
+                )
+            self._wake()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'window': self.limit(),
+                'in_flight': self.in_flight,
+                'last_decision': self.decisions[-1] if self.decisions else None,
+            }
+
+
+def _resolve(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class TokenBucket:
+    # GCRA form of a token bucket: `tat` is the theoretical arrival time of
+    # the next request, a request may go once now >= tat - tolerance.
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.interval = 1.0 / rate
+        self.tolerance = (self.burst - 1) * self.interval
+        self.tat = 0.0
+        self.penalty = 0.0
+
+    def reserve(self, now: float) -> float:
+        tat = max(self.tat, now)
+        start = max(now, tat - self.tolerance)
+        self.tat = tat + self.interval
+        return start - now
+
+    def block_until(self, until: float):
+        self.tat = max(self.tat, until + self.tolerance)
+
+    def clear_penalty(self):
+        self.penalty = 0.0
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
 class RateLimiter:
-    def __init__(self, max_requests_per_second=30):
+    # One token bucket per host. per_host maps a host to its own
+    # requests/second, or to (requests/second, burst).
+    def __init__(
+        self,
+        max_requests_per_second: float = 30,
+        burst: int = 1,
+        per_host: dict[str, float | tuple[float, int]] | None = None,
+        penalty: float = 5.0,
+        max_penalty: float = 120.0,
+    ):
         self.max_requests_per_second = max_requests_per_second
-        self.min_interval = 1.0 / max_requests_per_second
-        self.last_request_time = 0
+        self.burst = burst
+        self.per_host = per_host or {}
+        self.penalty = penalty
+        self.max_penalty = max_penalty
+        self.buckets: dict[str, TokenBucket] = {}
         self.lock = Lock()
 
-    def acquire(self):
+    clock = staticmethod(time.monotonic)
+
+    @classmethod
+    def from_env(cls, path: str | None = None, **kwargs) -> 'RateLimiter':
+        # CRAWLER_SHARED_LIMITS=<path> (or `path`) shares the buckets with
+        # every other process using the same file
+        path = os.getenv('CRAWLER_SHARED_LIMITS') or path
+        if path:
+            return SharedRateLimiter(path, **kwargs)
+        return cls(**kwargs)
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        if '://' not in url:
+            return url
+        return urllib.parse.urlsplit(url).netloc
+
+    def bucket(self, host: str) -> TokenBucket:
+        if host not in self.buckets:
+            conf = self.per_host.get(host, self.max_requests_per_second)
+            if isinstance(conf, tuple):
+                self.buckets[host] = TokenBucket(conf[0], conf[1])
+            else:
+                self.buckets[host] = TokenBucket(conf, self.burst)
+        return self.buckets[host]
+
+    def with_bucket(self, host: str, fn):
         with self.lock:
-            current_time = time.time()
-            elapsed = current_time - self.last_request_time
-            if elapsed < self.min_interval:
-                time.sleep(self.min_interval - elapsed)
-            self.last_request_time = time.time()
+            return fn(self.bucket(host))
+
+    def reserve(self, url: str = '') -> float:
+        # books a slot and returns how long the caller must wait for it;
+        # the caller sleeps without holding the lock
+        return self.with_bucket(
+            self.host_of(url), lambda bucket: bucket.reserve(self.clock())
+        )
+
+    def acquire(self, url: str = ''):
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, url: str = ''):
+        delay = self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def penalize(self, url: str = '', retry_after: float | None = None):
+        def apply(bucket: TokenBucket):
+            delay = retry_after
+            if delay is None:
+                # no hint from the server: back off exponentially
+                bucket.penalty = min(
+                    self.max_penalty, max(self.penalty, bucket.penalty * 2)
+                )
+                delay = bucket.penalty
+            bucket.block_until(self.clock() + delay)
+
+        self.with_bucket(self.host_of(url), apply)
+
+    def observe(self, response: requests.Response, url: str | None = None):
+        url = url or response.url
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if response.status_code == 429:
+            self.penalize(url, retry_after)
+        elif response.status_code == 503 and retry_after is not None:
+            self.penalize(url, retry_after)
+        else:
+            self.with_bucket(self.host_of(url), TokenBucket.clear_penalty)
 
     def reset(self):
         with self.lock:
-            self.last_request_time = 0
+            self.buckets = {}
+
+
+class SharedRateLimiter(RateLimiter):
+    # RateLimiter whose buckets live in a sqlite file, so all worker processes
+    # (or machines sharing the directory) draw from one budget per host.
+    # Buckets are kept in wall clock time since monotonic clocks differ
+    # between processes.
+    clock = staticmethod(time.time)
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS buckets '
+            '(host TEXT PRIMARY KEY, tat REAL, penalty REAL)'
+        )
+
+    def with_bucket(self, host: str, fn):
+        with self.lock:
+            bucket = self.bucket(host)
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute(
+                    'SELECT tat, penalty FROM buckets WHERE host = ?', (host,)
+                ).fetchone()
+                if row is not None:
+                    bucket.tat, bucket.penalty = row
+                before = (bucket.tat, bucket.penalty)
+                ret = fn(bucket)
+                if (bucket.tat, bucket.penalty) != before or row is None:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                        (host, bucket.tat, bucket.penalty),
+                    )
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return ret
+
+    def reset(self):
+        with self.lock:
+            self.buckets = {}
+            self.db.execute('DELETE FROM buckets')
 
 
 default_rate_limiter = RateLimiter()
 
 
+class SingleFlight:
+    # Concurrent calls of do() with the same key share one call of fn. With
+    # memo_size, the results of the last memo_size keys are kept for later
+    # calls as well. An exception reaches every caller of that flight but is
+    # not remembered. Results are shared, callers must not modify them.
+    def __init__(self, memo_size: int = 0):
+        self.memo_size = memo_size
+        self.results: OrderedDict = OrderedDict()
+        self.flights: dict[str, Future] = {}
+        self.lock = Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key: str, fn):
+        with self.lock:
+            if key in self.results:
+                self.shared += 1
+                self.results.move_to_end(key)
+                return self.results[key]
+            future = self.flights.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.flights[key] = future
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            ret = fn()
+        except BaseException as e:
+            with self.lock:
+                del self.flights[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            if self.memo_size:
+                self.results[key] = ret
+                if len(self.results) > self.memo_size:
+                    self.results.popitem(last=False)
+            del self.flights[key]
+        future.set_result(ret)
+        return ret
+
+    def forget(self, key: str):
+        with self.lock:
+            self.results.pop(key, None)
+
+    def stats(self) -> dict:
+        return {'calls': self.calls, 'shared': self.shared}
+
+
+class AsyncEngine:
+    # Runs requests on a private event loop so that cooldowns are awaited
+    # instead of slept, and a host keeps up to max_per_host requests in flight.
+    # The blocking requests call itself runs on the loop's executor, so the
+    # results are ordinary requests.Response objects.
+    def __init__(
+        self,
+        max_in_flight=512,
+        max_per_host=POOL_MAXSIZE,
+        metrics: Metrics | None = default_metrics,
+        recorder: Cassette | None = None,
+        replay: str | None = None,
+    ):
+        # recorder stores every response it sees, replay is the base url of a
+        # utils/replay.py server that all requests are redirected to
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.metrics = metrics
+        self.recorder = recorder
+        self.replay = replay
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.thread: Thread | None = None
+        self.host_slots: dict[str, asyncio.Semaphore] = {}
+        self.lock = Lock()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(
+                    ThreadPoolExecutor(
+                        max_workers=self.max_in_flight,
+                        thread_name_prefix='network',
+                    )
+                )
+                self.thread = Thread(
+                    target=loop.run_forever, name='network-engine', daemon=True
+                )
+                self.thread.start()
+                self.loop = loop
+            return self.loop
+
+    def host_slot(self, host: str) -> asyncio.Semaphore:
+        # only called from the engine loop, no lock needed
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(self.max_per_host)
+        return self.host_slots[host]
+
+    async def get(
+        self,
+        url: str,
+        path: str | None = None,
+        headers={},
+        cookies={},
+        timeout: float = 10,
+        cooldown: float = 0,
+        session: requests.Session | None = None,
+        dynamic_cooldown: DynamicCooldown | None = None,
+        rate_limiter: RateLimiter | None = None,
+        controller: ConcurrencyController | None = None,
+        cache: HttpCache | None = None,
+        sha256: str | None = None,
+        manifest: DownloadManifest | None = None,
+    ) -> requests.Response:
+        loop = asyncio.get_running_loop()
+        session = session or global_session
+        host = urllib.parse.urlsplit(url).netloc
+        request_headers = headers
+        cache_entry = None
+        if cache and path is None:
+            cache_entry = await loop.run_in_executor(None, cache.lookup, url, headers)
+            if cache_entry is not None:
+                if cache.is_fresh(cache_entry):
+                    r = await loop.run_in_executor(None, cache.hit, cache_entry)
+                    if self.metrics:
+                        self.metrics.observe(url, r.status_code, 0.0, cached=True)
+                    return r
+                request_headers = {
+                    **headers,
+                    **cache.conditional_headers(cache_entry),
+                }
+        async with self.host_slot(host):
+            if controller:
+                await controller.acquire_async()
+            try:
+                if rate_limiter:
+                    await rate_limiter.acquire_async(url)
+                fetch_url = url
+                if self.replay:
+                    fetch_url, request_headers = to_replay(
+                        self.replay, url, request_headers
+                    )
+                if path is None:
+                    fetch = partial(
+                        session.get,
+                        fetch_url,
+                        headers=request_headers,
+                        cookies=cookies,
+                        timeout=timeout,
+                    )
+                else:
+                    fetch = partial(
+                        _blocking_download,
+                        session,
+                        fetch_url,
+                        path,
+                        headers=request_headers,
+                        cookies=cookies,
+                        timeout=timeout,
+                        sha256=sha256,
+                        manifest=manifest,
+                    )
+                start = time.monotonic()
+                try:
+                    r = await loop.run_in_executor(None, fetch)
+                except Exception:
+                    if controller:
+                        controller.update(time.monotonic() - start, 0)
+                    if self.metrics:
+                        self.metrics.error(url)
+                    raise
+                if controller:
+                    controller.update(r.elapsed.total_seconds(), r.status_code)
+            finally:
+                if controller:
+                    controller.release()
+            if rate_limiter:
+                rate_limiter.observe(r, url)
+            status = r.status_code
+            nbytes = _transferred(r, path)
+            retries = _retries(r)
+            if cache and path is None:
+                r = await loop.run_in_executor(
+                    None, cache.update, url, headers, r, cache_entry
+                )
+            if self.recorder is not None:
+                await loop.run_in_executor(None, self.recorder.record, url, r, path)
+            elapsed = r.elapsed.total_seconds()
+            if dynamic_cooldown:
+                dynamic_cooldown.update(elapsed)
+            # the host slot stays taken during the cooldown, so the request
+            # rate per slot is the same as the old sleeping workers
+            slept = max(0.0, cooldown - elapsed)
+            if slept > 0:
+                await asyncio.sleep(slept)
+            if self.metrics:
+                self.metrics.observe(
+                    url,
+                    status,
+                    elapsed,
+                    nbytes,
+                    retries=retries,
+                    cooldown=slept,
+                    cached=status == 304 and r.status_code == 200,
+                )
+        return r
+
+    def submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def run(self, coro):
+        # must not be called from the engine loop itself
+        return self.submit(coro).result()
+
+    def close(self):
+        with self.lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            assert self.thread is not None
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+            self.host_slots = {}
+
+
+default_engine = AsyncEngine(
+    recorder=Cassette(os.environ['CRAWLER_RECORD'])
+    if os.getenv('CRAWLER_RECORD')
+    else None,
+    replay=os.getenv('CRAWLER_REPLAY') or None,
+)
+
+
+class IncompleteDownload(requests.RequestException):
+    pass
+
+
+def _blocking_download(
+    session: requests.Session,
+    url: str,
+    path: str,
+    headers={},
+    sha256: str | None = None,
+    manifest: DownloadManifest | None = None,
+    **kwargs,
+) -> requests.Response:
+    # Streams into path + '.part' and renames it into place once the size and
+    # digest check out. A leftover .part is resumed with a Range request.
+    part = path + '.part'
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    # byte ranges only make sense on the unencoded body
+    request_headers = {**headers, 'Accept-Encoding': 'identity'}
+    if offset > 0:
+        request_headers['Range'] = 'bytes={}-'.format(offset)
+    r = session.get(url, stream=True, headers=request_headers, **kwargs)
+    if r.status_code == 416 and offset > 0:
+        # the partial file does not match the remote one any more
+        r.close()
+        os.remove(part)
+        return _blocking_download(
+            session, url, path, headers, sha256=sha256, manifest=manifest, **kwargs
+        )
+    encoded = r.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+    if encoded and r.status_code == 206 and offset > 0:
+        # an encoded range cannot be decoded on its own, start over
+        r.close()
+        os.remove(part)
+        return _blocking_download(
+            session, url, path, headers, sha256=sha256, manifest=manifest, **kwargs
+        )
+    if r.status_code == 206:
+        content_range = r.headers.get('Content-Range', '')
+        if not content_range.startswith('bytes {}-'.format(offset)):
+            r.close()
+            if os.path.exists(part):
+                os.remove(part)
+            return _blocking_download(
+                session, url, path, headers, sha256=sha256, manifest=manifest, **kwargs
+            )
+        total = content_range.rpartition('/')[2]
+        expected = int(total) if total.isdigit() else None
+        mode = 'ab'
+    elif r.status_code == 200:
+        length = r.headers.get('Content-Length')
+        expected = int(length) if length and length.isdigit() else None
+        mode = 'wb'
+        if encoded:
+            # the server ignored Accept-Encoding: identity; the file gets the
+            # decoded body, whose size Content-Length does not tell
+            r.raw.decode_content = True
+            expected = None
+    else:
+        return r
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        try:
+            with open(part, mode) as f:
+                shutil.copyfileobj(r.raw, f)
+        except urllib3.exceptions.HTTPError as e:
+            # connection dropped mid-body, the .part file is resumed next time
+            raise IncompleteDownload(str(e), request=r.request, response=r) from e
+        size = os.path.getsize(part)
+        if expected is not None and size < expected:
+            # keep the partial file, the next attempt resumes it
+            raise IncompleteDownload(
+                'got {} of {} bytes'.format(size, expected),
+                request=r.request,
+                response=r,
+            )
+        if expected is not None and size > expected:
+            os.remove(part)
+            raise IncompleteDownload(
+                'got {} bytes, expected {}'.format(size, expected),
+                request=r.request,
+                response=r,
+            )
+        digest = None
+        if sha256 is not None:
+            h = hashlib.sha256()
+            with open(part, 'rb') as f:
+                for chunk in iter(partial(f.read, 1 << 20), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            if digest != sha256.lower().removeprefix('sha256:'):
+                os.remove(part)
+                raise IncompleteDownload(
+                    'sha256 mismatch for {}'.format(path), request=r.request, response=r
+                )
+    except BaseException:
+        # the body may be half read, give the connection back
+        r.close()
+        raise
+    os.replace(part, path)
+    if manifest is not None:
+        verified = expected is not None or digest is not None
+        manifest.record(path, url, size, digest, verified=verified)
+    return r
+
+
+def _transferred(r: requests.Response, path: str | None) -> int:
+    if path is None:
+        return len(r.content)
+    try:
+        return r.raw.tell()
+    except Exception:
+        return 0
+
+
+def _retries(r: requests.Response) -> int:
+    retries = getattr(r.raw, 'retries', None)
+    if retries is None:
+        return 0
+    return len(retries.history)
+
+
+def _pick_cooldown(
+    cooldown: float, jitter: float, dynamic_cooldown: DynamicCooldown | None
+) -> float:
+    if dynamic_cooldown:
+        return dynamic_cooldown.get()
+    elif jitter > 0:
+        return cooldown * random.uniform(1 - jitter, 1 + jitter)
+    else:
+        return cooldown
+
+
+def _write(bar: tqdm | None, s: str, end: str = '\n'):
+    if bar:
+        bar.write(s, end=end)
+    else:
+        print(s, end=end)
+
+
 def safe_get(
     url: str,
     bar: tqdm | None = None,
@@ -97,53 +788,129 @@ def safe_get(
     session: requests.Session | None = None,
     dynamic_cooldown: DynamicCooldown | None = None,
     rate_limiter: RateLimiter | None = None,
+    controller: ConcurrencyController | None = None,
+    cache: HttpCache | None = None,
+    engine: AsyncEngine | None = None,
 ) -> requests.Response:
-    if dynamic_cooldown:
-        actual_cooldown = dynamic_cooldown.get()
-    elif jitter > 0:
-        actual_cooldown = cooldown * random.uniform(1 - jitter, 1 + jitter)
-    else:
-        actual_cooldown = cooldown
-
-    if rate_limiter:
-        rate_limiter.acquire()
-
-    if not session:
-        global global_session
-        session = global_session
+    actual_cooldown = _pick_cooldown(cooldown, jitter, dynamic_cooldown)
+    engine = engine or default_engine
     url_readable = urllib.parse.unquote(url)
     if verbose:
-        if bar:
-            bar.write('GET: {} '.format(url_readable), end='')
-        else:
-            print('GET: {} '.format(url_readable), end='')
-    r = session.get(url, headers=headers, cookies=cookies, timeout=timeout)
+        _write(bar, 'GET: {} '.format(url_readable), end='')
+    r = engine.run(
+        engine.get(
+            url,
+            headers=headers,
+            cookies=cookies,
+            timeout=timeout,
+            cooldown=actual_cooldown,
+            session=session,
+            dynamic_cooldown=dynamic_cooldown,
+            rate_limiter=rate_limiter,
+            controller=controller,
+            cache=cache,
+        )
+    )
     r.encoding = 'utf-8'
     elapsed = r.elapsed.total_seconds()
-    
-    if dynamic_cooldown:
-        dynamic_cooldown.update(elapsed)
-        if verbose:
-            if bar:
-                bar.write('{} in {:.3f}s (cooldown: {:.2f}s)'.format(r.status_code, elapsed, actual_cooldown))
-            else:
-                print('{} in {:.3f}s (cooldown: {:.2f}s)'.format(r.status_code, elapsed, actual_cooldown))
-    else:
-        if verbose:
-            if bar:
-                bar.write('{} in {:.3f}s'.format(r.status_code, elapsed))
-            else:
-                print('{} in {:.3f}s'.format(r.status_code, elapsed))
-    
+
+    if verbose:
+        if dynamic_cooldown:
+            _write(
+                bar,
+                '{} in {:.3f}s (cooldown: {:.2f}s)'.format(
+                    r.status_code, elapsed, actual_cooldown
+                ),
+            )
+        else:
+            _write(bar, '{} in {:.3f}s'.format(r.status_code, elapsed))
+
     if r.status_code != 200:
-        if elapsed < actual_cooldown:
-            time.sleep(actual_cooldown - elapsed)
         raise requests.HTTPError(request=r.request, response=r)
-    if elapsed < actual_cooldown:
-        time.sleep(actual_cooldown - elapsed)
     return r
 
 
+def safe_get_many(
+    urls: Iterable[str],
+    bar: tqdm | None = None,
+    concurrency: int = 16,
+    headers={},
+    cookies={},
+    timeout: float = 10,
+    cooldown: float = 3,
+    jitter: float = 0.5,
+    verbose: bool = True,
+    session: requests.Session | None = None,
+    dynamic_cooldown: DynamicCooldown | None = None,
+    rate_limiter: RateLimiter | None = None,
+    controller: ConcurrencyController | None = None,
+    cache: HttpCache | None = None,
+    engine: AsyncEngine | None = None,
+) -> Iterator[tuple[str, requests.Response | Exception]]:
+    # Yields (url, response or exception) in completion order while keeping
+    # at most `concurrency` requests queued on the engine. Non-200 responses
+    # come back as requests.HTTPError, like safe_get raises them.
+    engine = engine or default_engine
+    it = iter(urls)
+    pending: dict[Future, tuple[str, float]] = {}
+
+    def fill():
+        for url in it:
+            actual_cooldown = _pick_cooldown(cooldown, jitter, dynamic_cooldown)
+            future = engine.submit(
+                engine.get(
+                    url,
+                    headers=headers,
+                    cookies=cookies,
+                    timeout=timeout,
+                    cooldown=actual_cooldown,
+                    session=session,
+                    dynamic_cooldown=dynamic_cooldown,
+                    rate_limiter=rate_limiter,
+                    controller=controller,
+                    cache=cache,
+                )
+            )
+            pending[future] = (url, actual_cooldown)
+            if len(pending) >= concurrency:
+                break
+
+    try:
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, actual_cooldown = pending.pop(future)
+                try:
+                    r = future.result()
+                except Exception as e:
+                    if verbose:
+                        _write(
+                            bar, 'GET: {} {}'.format(urllib.parse.unquote(url), e)
+                        )
+                    yield url, e
+                    continue
+                r.encoding = 'utf-8'
+                if verbose:
+                    _write(
+                        bar,
+                        'GET: {} {} in {:.3f}s (cooldown: {:.2f}s)'.format(
+                            urllib.parse.unquote(url),
+                            r.status_code,
+                            r.elapsed.total_seconds(),
+                            actual_cooldown,
+                        ),
+                    )
+                if r.status_code != 200:
+                    yield url, requests.HTTPError(request=r.request, response=r)
+                else:
+                    yield url, r
+            fill()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
 def safe_download(
     url: str,
     path: str,
@@ -157,55 +924,45 @@ def safe_download(
     session: requests.Session | None = None,
     dynamic_cooldown: DynamicCooldown | None = None,
     rate_limiter: RateLimiter | None = None,
-):
-    if dynamic_cooldown:
-        actual_cooldown = dynamic_cooldown.get()
-    elif jitter > 0:
-        actual_cooldown = cooldown * random.uniform(1 - jitter, 1 + jitter)
-    else:
-        actual_cooldown = cooldown
-
-    if rate_limiter:
-        rate_limiter.acquire()
-
-    if not session:
-        global global_session
-        session = global_session
-    url_readable = urllib.parse.unquote(url)
-    r = session.get(url, stream=True, headers=headers, cookies=cookies, timeout=timeout)
-    if verbose:
-        if bar:
-            bar.write('Download {} '.format(url_readable), end='')
-        else:
-            print('Download {} '.format(url_readable), end='')
-    if r.status_code != 200:
+    controller: ConcurrencyController | None = None,
+    sha256: str | None = None,
+    manifest: DownloadManifest | None = None,
+    engine: AsyncEngine | None = None,
+) -> requests.Response | None:
+    # returns None when the manifest already lists path
+    if manifest is not None and manifest.done(path):
         if verbose:
-            if bar:
-                bar.write('ERROR: {}'.format(r.status_code))
-            else:
-                print('ERROR: {}'.format(r.status_code))
-    else:
-        with open(path, 'wb') as f:
-            r.raw.decode_content = True
-            shutil.copyfileobj(r.raw, f)
+            _write(bar, 'skip: {}'.format(path))
+        return None
+    actual_cooldown = _pick_cooldown(cooldown, jitter, dynamic_cooldown)
+    engine = engine or default_engine
+    url_readable = urllib.parse.unquote(url)
+    r = engine.run(
+        engine.get(
+            url,
+            path=path,
+            headers=headers,
+            cookies=cookies,
+            timeout=timeout,
+            cooldown=actual_cooldown,
+            session=session,
+            dynamic_cooldown=dynamic_cooldown,
+            rate_limiter=rate_limiter,
+            controller=controller,
+            sha256=sha256,
+            manifest=manifest,
+        )
+    )
     elapsed = r.elapsed.total_seconds()
-    
-    if dynamic_cooldown:
-        dynamic_cooldown.update(elapsed)
-        if verbose:
-            if bar:
-                bar.write('{:.3f}s (cooldown: {:.2f}s)'.format(elapsed, actual_cooldown))
-            else:
-                print('{:.3f}s (cooldown: {:.2f}s)'.format(elapsed, actual_cooldown))
-    else:
-        if verbose:
-            if bar:
-                bar.write('{:.3f}s'.format(elapsed))
-            else:
-                print('{:.3f}s'.format(elapsed))
-    
-    if elapsed < actual_cooldown:
-        time.sleep(actual_cooldown - elapsed)
+    if r.status_code not in (200, 206):
+        # failures are reported even when not verbose
+        _write(bar, 'Download {} ERROR: {}'.format(url_readable, r.status_code))
+    elif verbose:
+        _write(bar, 'Download {} '.format(url_readable), end='')
+        if dynamic_cooldown:
+            _write(bar, '{:.3f}s (cooldown: {:.2f}s)'.format(elapsed, actual_cooldown))
+        else:
+            _write(bar, '{:.3f}s'.format(elapsed))
     return r
 
 
@@ -220,8 +977,14 @@ def safe_soup(
     session: requests.Session | None = None,
     dynamic_cooldown: DynamicCooldown | None = None,
     rate_limiter: RateLimiter | None = None,
+    controller: ConcurrencyController | None = None,
+    cache: HttpCache | None = None,
+    engine: AsyncEngine | None = None,
+    parse_only: SoupStrainer | None = None,
+    parser: str | None = None,
 ) -> BeautifulSoup:
-    return BeautifulSoup(
+    # parse_only limits the tree to the matching elements, see utils/soup.py
+    return make_soup(
         safe_get(
             url,
             bar=bar,
@@ -233,8 +996,12 @@ def safe_soup(
             session=session,
             dynamic_cooldown=dynamic_cooldown,
             rate_limiter=rate_limiter,
+            controller=controller,
+            cache=cache,
+            engine=engine,
         ).text,
-        'html.parser',
+        parse_only=parse_only,
+        parser=parser,
     )
 
 
@@ -242,5 +1009,10 @@ def quote_all(url):
     return urllib.parse.quote(url.lstrip('/'), safe="")
 
 
+def canonical_url(url):
+    # one spelling per page: percent-decoded, spaces as underscores, no fragment
+    return urllib.parse.unquote(url).split('#')[0].replace(' ', '_')
+
+
 def title_to_url(title):
     return quote_all(title.replace(' ', '_'))
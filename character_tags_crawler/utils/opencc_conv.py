@@ -0,0 +1,75 @@
+# OpenCC conversions shared by the scripts. Each OpenCC config is loaded
+# once, and a Conversion (a chain of configs) remembers its last MEMO_SIZE
+# results, since the same names are converted over and over. many()
+# converts a list of strings with one OpenCC call per config for the ones
+# not seen yet.
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Iterable
+
+import opencc
+
+MEMO_SIZE = 1 << 18
+# joins the strings of a batch; OpenCC keeps it as is and never converts
+# across it
+SEPARATOR = '\n'
+
+
+@lru_cache(maxsize=None)
+def load_converter(config: str) -> opencc.OpenCC:
+    return opencc.OpenCC(config)
+
+
+class Conversion:
+    def __init__(self, *configs: str, memo_size: int = MEMO_SIZE):
+        self.converters = [load_converter(config) for config in configs]
+        self.memo_size = memo_size
+        self.memo: OrderedDict[str, str] = OrderedDict()
+
+    def convert(self, text: str) -> str:
+        for converter in self.converters:
+            text = converter.convert(text)
+        return text
+
+    def remember(self, text: str, result: str):
+        self.memo[text] = result
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+    def __call__(self, text: str) -> str:
+        try:
+            self.memo.move_to_end(text)
+            return self.memo[text]
+        except KeyError:
+            ret = self.convert(text)
+            self.remember(text, ret)
+            return ret
+
+    def many(self, texts: Iterable[str]) -> list[str]:
+        ret = []
+        # positions of the results still to convert
+        missing: dict[str, list[int]] = {}
+        for text in texts:
+            try:
+                self.memo.move_to_end(text)
+                ret.append(self.memo[text])
+            except KeyError:
+                missing.setdefault(text, []).append(len(ret))
+                ret.append(text)
+        if len(missing) > 1 and not any(SEPARATOR in text for text in missing):
+            results = self.convert(SEPARATOR.join(missing)).split(SEPARATOR)
+            if len(results) != len(missing):
+                results = [self.convert(text) for text in missing]
+        else:
+            results = [self.convert(text) for text in missing]
+        for (text, positions), result in zip(missing.items(), results):
+            self.remember(text, result)
+            for i in positions:
+                ret[i] = result
+        return ret
+
+
+# traditional -> simplified
+t2s = Conversion('t2s.json')
+# japanese kanji -> traditional -> simplified
+jp2s = Conversion('jp2t.json', 't2s.json')
@@ -0,0 +1,214 @@
+# Single-file store for many small records, e.g. the wikitext of every
+# character page. Records are appended as
+#
+#   header (magic, codec, key/meta/data lengths) | key | meta json | data
+#
+# and a newer record replaces an older one with the same key. The offset
+# index is rebuilt from the headers when the file is opened and reads go
+# through mmap. Data is compressed with zstd (compression.zstd on Python
+# 3.14+, else the zstandard package) or zlib when neither is installed.
+# One process writes a pack at a time. `python utils/pack.py <pack>` prints
+# its contents, `--compact` drops replaced records.
+import argparse
+import json
+import mmap
+import os
+import struct
+import zlib
+from collections import Counter
+from threading import Lock
+from typing import Iterator
+
+try:
+    from compression import zstd
+
+    def zstd_compress(data: bytes) -> bytes:
+        return zstd.compress(data, level=ZSTD_LEVEL)
+
+    zstd_decompress = zstd.decompress
+except ImportError:
+    try:
+        import zstandard
+
+        def zstd_compress(data: bytes) -> bytes:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+        def zstd_decompress(data: bytes) -> bytes:
+            return zstandard.ZstdDecompressor().decompress(data)
+
+    except ImportError:
+        zstd_compress = zstd_decompress = None
+
+ZSTD_LEVEL = 10
+FILE_MAGIC = b'CCBPACK1'
+RECORD_MAGIC = b'PR'
+# magic, codec, key length, meta length, data length
+HEADER = struct.Struct('<2sBHII')
+
+RAW = 0
+ZLIB = 1
+ZSTD = 2
+CODEC_NAMES = {RAW: 'raw', ZLIB: 'zlib', ZSTD: 'zstd'}
+
+
+def compress(data: bytes) -> tuple[int, bytes]:
+    if zstd_compress is not None:
+        return ZSTD, zstd_compress(data)
+    return ZLIB, zlib.compress(data, 9)
+
+
+def decompress(codec: int, data: bytes) -> bytes:
+    if codec == RAW:
+        return data
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == ZSTD:
+        if zstd_decompress is None:
+            raise RuntimeError(
+                'zstd records need Python 3.14+ or `pip install zstandard`'
+            )
+        return zstd_decompress(data)
+    raise ValueError(f'unknown codec {codec}')
+
+
+class Pack:
+    def __init__(self, path: str):
+        self.path = path
+        # key -> (offset of the data, codec, meta length, data length)
+        self.index: dict[str, tuple[int, int, int, int]] = {}
+        self.records = 0
+        self.lock = Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(FILE_MAGIC)
+        self.file = open(path, 'r+b')
+        self.map = None
+        self.remap()
+        if self.map[: len(FILE_MAGIC)] != FILE_MAGIC:
+            raise ValueError(f'{path} is not a pack file')
+        end = self.scan()
+        if end < len(self.map):
+            # torn record from a killed writer
+            self.map.close()
+            self.file.truncate(end)
+            self.remap()
+        self.file.seek(0, os.SEEK_END)
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def scan(self) -> int:
+        pos = len(FILE_MAGIC)
+        size = len(self.map)
+        while pos + HEADER.size <= size:
+            magic, codec, key_len, meta_len, data_len = HEADER.unpack_from(
+                self.map, pos
+            )
+            start = pos + HEADER.size
+            end = start + key_len + meta_len + data_len
+            if magic != RECORD_MAGIC or end > size:
+                break
+            key = self.map[start : start + key_len].decode('utf-8')
+            self.index[key] = (start + key_len, codec, meta_len, data_len)
+            self.records += 1
+            pos = end
+        return pos
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> Iterator[str]:
+        return iter(list(self.index))
+
+    def read(self, key: str) -> tuple[dict | None, bytes] | None:
+        with self.lock:
+            if key not in self.index:
+                return None
+            offset, codec, meta_len, data_len = self.index[key]
+            if offset + meta_len + data_len > len(self.map):
+                # written after the map was made
+                self.file.flush()
+                self.remap()
+            meta = self.map[offset : offset + meta_len]
+            data = self.map[offset + meta_len : offset + meta_len + data_len]
+        return (json.loads(meta) if meta else None), decompress(codec, data)
+
+    def get(self, key: str) -> bytes | None:
+        ret = self.read(key)
+        return None if ret is None else ret[1]
+
+    def meta(self, key: str) -> dict | None:
+        with self.lock:
+            if key not in self.index:
+                return None
+            offset, _, meta_len, _ = self.index[key]
+            if offset + meta_len > len(self.map):
+                self.file.flush()
+                self.remap()
+            meta = self.map[offset : offset + meta_len]
+        return json.loads(meta) if meta else None
+
+    def put(self, key: str, data: bytes, meta: dict | None = None):
+        codec, payload = compress(data)
+        key_bytes = key.encode('utf-8')
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode() if meta else b''
+        header = HEADER.pack(
+            RECORD_MAGIC, codec, len(key_bytes), len(meta_bytes), len(payload)
+        )
+        with self.lock:
+            pos = self.file.tell()
+            self.file.write(header + key_bytes + meta_bytes + payload)
+            offset = pos + HEADER.size + len(key_bytes)
+            self.index[key] = (offset, codec, len(meta_bytes), len(payload))
+            self.records += 1
+
+    def flush(self, sync: bool = False):
+        with self.lock:
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.map.close()
+            self.file.close()
+
+
+def compact(path: str):
+    # rewrites the pack with only the latest record of each key
+    src = Pack(path)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    dst = Pack(tmp)
+    for key in src.keys():
+        meta, data = src.read(key)
+        dst.put(key, data, meta)
+    dst.close()
+    src.close()
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='inspect a pack file')
+    parser.add_argument('pack')
+    parser.add_argument('--compact', action='store_true')
+    args = parser.parse_args()
+
+    if args.compact:
+        compact(args.pack)
+    pack = Pack(args.pack)
+    codecs = Counter(CODEC_NAMES.get(i[1], str(i[1])) for i in pack.index.values())
+    stored = sum(i[3] for i in pack.index.values())
+    print(f'{len(pack)} keys, {pack.records - len(pack)} replaced records')
+    print(f'{os.path.getsize(args.pack)} bytes on disk, {stored} bytes of live data')
+    print('codecs:', dict(codecs))
@@ -0,0 +1,91 @@
+# Runs a CPU-bound function (wikitext parsing) over many items in worker
+# processes. Items are sent in chunks, results come back in the order of
+# the items, and an exception is reported with the item it was raised for
+# instead of ending the run. PARSE_WORKERS sets the number of processes,
+# default one per core; PARSE_WORKERS=1 runs everything in this process.
+# PARSE_START_METHOD picks the multiprocessing start method (fork,
+# forkserver or spawn), default the platform's.
+#
+# Except under fork the workers import the main script again as
+# __mp_main__, so fn has to be a module-level function, scripts using
+# process_map keep their work under `if __name__ == '__main__':`, and
+# whatever fn reads (e.g. an index file) must be loaded at import time,
+# not in that block. check_workers compares a pool against this process.
+import multiprocessing
+import os
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+WORKERS = int(os.getenv('PARSE_WORKERS', '0')) or os.cpu_count() or 1
+START_METHOD = os.getenv('PARSE_START_METHOD') or None
+CHUNK_SIZE = 64
+
+
+def run_chunk(
+    fn: Callable[[T], R], chunk: list[T]
+) -> list[tuple[R | None, str | None]]:
+    # tracebacks are sent back as text, they do not pickle
+    ret = []
+    for item in chunk:
+        try:
+            ret.append((fn(item), None))
+        except Exception:
+            ret.append((None, traceback.format_exc()))
+    return ret
+
+
+def process_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    workers: int | None = None,
+    chunk_size: int = CHUNK_SIZE,
+    start_method: str | None = START_METHOD,
+) -> Iterator[tuple[R | None, str | None]]:
+    # yields (fn(item), None) or (None, traceback) for each item, in order.
+    # items is read lazily and only a few chunks per worker are in flight
+    workers = workers or WORKERS
+    it = iter(items)
+    chunks = iter(lambda: list(islice(it, chunk_size)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield from run_chunk(fn, chunk)
+        return
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(start_method)
+    )
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(run_chunk, fn, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        # also reached when the caller stops early
+        executor.shutdown(cancel_futures=True)
+
+
+def check_workers(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    start_method: str = 'forkserver',
+    workers: int = 2,
+) -> list[int]:
+    # positions of the items for which a pool started with start_method
+    # gives another result or error than this process, e.g. because fn
+    # reads a global that only the __main__ block sets
+    items = list(items)
+    local = list(process_map(fn, items, workers=1))
+    pooled = process_map(fn, items, workers=workers, start_method=start_method)
+    return [
+        i
+        for i, (a, b) in enumerate(zip(local, pooled))
+        if a[0] != b[0] or (a[1] is None) != (b[1] is None)
+    ]
@@ -0,0 +1,222 @@
+# Record/replay of crawler traffic for offline benchmarks.
+#
+# Record:  CRAWLER_RECORD=bench.cassette python moegirl/crawler/crawler.py
+# Serve:   python utils/replay.py bench.cassette --port 8000 --error-rate 0.01
+# Replay:  CRAWLER_REPLAY=http://127.0.0.1:8000 python moegirl/crawler/crawler.py
+#
+# In replay mode the engine sends every request to the replay server and puts
+# the original scheme and host into X-Replay-Origin, so rate limits, caches and
+# metrics still see the production hosts.
+import argparse
+import json
+import random
+import sqlite3
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+
+import requests
+
+ORIGIN_HEADER = 'X-Replay-Origin'
+DROPPED_HEADERS = {
+    'connection',
+    'content-encoding',
+    'content-length',
+    'keep-alive',
+    'transfer-encoding',
+}
+
+
+def cassette_key(url: str) -> str:
+    # the url as requests sends it (and the replay server sees it): callers
+    # pass titles unquoted, the wire has them percent-encoded
+    return requests.utils.requote_uri(url)
+
+
+class Cassette:
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS interactions ('
+            'url TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, '
+            'elapsed REAL, recorded REAL)'
+        )
+        # cassettes recorded before the keys were normalized
+        for (url,) in self.db.execute('SELECT url FROM interactions').fetchall():
+            if cassette_key(url) != url:
+                self.db.execute(
+                    'UPDATE OR REPLACE interactions SET url = ? WHERE url = ?',
+                    (cassette_key(url), url),
+                )
+        self.db.commit()
+        self.lock = Lock()
+
+    def record(self, url: str, response: requests.Response, path: str | None = None):
+        if path is not None:
+            if response.status_code not in (200, 206):
+                return
+            with open(path, 'rb') as f:
+                body = f.read()
+            status = 200
+        else:
+            body = response.content
+            status = response.status_code
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k.lower() not in DROPPED_HEADERS
+        }
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO interactions VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    cassette_key(url),
+                    status,
+                    json.dumps(headers),
+                    body,
+                    response.elapsed.total_seconds(),
+                    time.time(),
+                ),
+            )
+            self.db.commit()
+
+    def lookup(self, url: str) -> tuple[int, dict, bytes, float] | None:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT status, headers, body, elapsed FROM interactions WHERE url = ?',
+                (cassette_key(url),),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2], row[3]
+
+    def urls(self) -> list[str]:
+        with self.lock:
+            return [i[0] for i in self.db.execute('SELECT url FROM interactions')]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM interactions').fetchone()[0]
+
+
+def to_replay(replay: str, url: str, headers: dict) -> tuple[str, dict]:
+    # https://host/a?b -> <replay>/a?b with the origin moved into a header
+    parts = urllib.parse.urlsplit(url)
+    target = replay.rstrip('/') + urllib.parse.urlunsplit(
+        ('', '', parts.path or '/', parts.query, '')
+    )
+    return target, {**headers, ORIGIN_HEADER: parts.scheme + '://' + parts.netloc}
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        host: str = '127.0.0.1',
+        port: int = 8000,
+        latency: float | None = None,
+        jitter: float = 0.0,
+        latency_scale: float = 1.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        retry_after: int | None = None,
+    ):
+        # latency None replays the recorded response times (times latency_scale)
+        super().__init__((host, port), ReplayHandler)
+        self.cassette = cassette
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.served = 0
+        self.missing = 0
+        self.injected = 0
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    server: ReplayServer
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        origin = self.headers.get(ORIGIN_HEADER, '')
+        hit = server.cassette.lookup(origin + self.path)
+        if server.latency is not None:
+            delay = server.latency
+        elif hit is not None:
+            delay = hit[3] * server.latency_scale
+        else:
+            delay = 0.0
+        if server.jitter > 0:
+            delay += random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < server.error_rate:
+            server.injected += 1
+            headers = {}
+            if server.retry_after is not None:
+                headers['Retry-After'] = str(server.retry_after)
+            self.reply(server.error_status, headers, b'injected error')
+        elif hit is None:
+            server.missing += 1
+            self.reply(404, {}, b'not in cassette')
+        else:
+            server.served += 1
+            status, headers, body, _ = hit
+            self.reply(status, headers, body)
+
+    def reply(self, status: int, headers: dict, body: bytes):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve a recorded cassette')
+    parser.add_argument('cassette')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument(
+        '--latency', type=float, default=None, help='fixed latency in seconds'
+    )
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--retry-after', type=int, default=None)
+    args = parser.parse_args()
+
+    cassette = Cassette(args.cassette)
+    server = ReplayServer(
+        cassette,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        latency_scale=args.latency_scale,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+    )
+    print(f'serving {len(cassette)} responses on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(
+        f'served={server.served} missing={server.missing} injected={server.injected}'
+    )
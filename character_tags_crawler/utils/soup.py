@@ -0,0 +1,37 @@
+# HTML parsing for the crawlers. lxml is used when it is installed and
+# html.parser otherwise; HTML_PARSER=<name> forces a BeautifulSoup backend.
+# Pages are large and the crawlers read one element of them, so callers
+# should pass parse_only to build only that subtree.
+import html
+import os
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
+
+PARSER = os.getenv('HTML_PARSER') or DEFAULT_PARSER
+
+TEXTAREA_RE = re.compile(r'<textarea\b[^>]*>(.*?)</textarea>', re.S | re.I)
+
+
+def make_soup(
+    text: str | bytes,
+    parse_only: SoupStrainer | None = None,
+    parser: str | None = None,
+) -> BeautifulSoup:
+    return BeautifulSoup(text, parser or PARSER, parse_only=parse_only)
+
+
+def extract_textarea(text: str) -> str | None:
+    # contents of the first <textarea>, e.g. the wikitext on an edit page,
+    # without building a tree; None if the page has no textarea
+    m = TEXTAREA_RE.search(text)
+    if m is None:
+        return None
+    return html.unescape(m.group(1))